@@ -0,0 +1,610 @@
+# asyncioのイベントループ1つで動作するランタイム
+# スレッドとqueue.Queueの代わりにタスクと上限付きのasyncio.Queueで各処理をつなぐ
+# config.tomlの[runtime]でmode = "asyncio"を指定すると使用される
+# 1つのプロセスで複数のセッション(ギルドごとのVC)を同時に扱える
+
+# 標準ライブラリのimport
+import asyncio
+import copy
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+# サードパーティライブラリのimport
+import websockets
+# 独自ライブラリのimport
+from chunker import plan_chunks
+from ecot import ECOT_JSON_SCHEMA, extract_ecot_reply
+from main import EMOJI_PATTERN, SPEAKABLE_PATTERN, EmotionalAI, ReplyStream
+from startup import await_until_ready
+
+# session:<id>を送ってこない接続が使うセッション
+DEFAULT_SESSION_ID = "default"
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+# 同時実行数を制限しつつ、空いた枠をセッションごとに順番に割り当てるクラス
+# 1つのセッションが大量にリクエストしても他のセッションが待たされ続けないようにする
+class FairLimiter:
+
+    def __init__(self, capacity):
+        self.capacity = max(1, capacity)
+        self.in_use = 0
+        self.waiters = OrderedDict()  # セッションID -> 待っているFutureのdeque
+
+    async def acquire(self, key):
+        if self.in_use < self.capacity and not self.waiters:
+            self.in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(key, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 枠が割り当てられた直後に取り消された場合は枠を返す
+                self.release()
+            else:
+                waiters = self.waiters.get(key)
+                if waiters is not None and future in waiters:
+                    waiters.remove(future)
+                    if not waiters:
+                        del self.waiters[key]
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        while self.in_use < self.capacity and self.waiters:
+            # 先頭のセッションに1つ割り当て、まだ待っていれば最後尾に回す
+            key, waiters = next(iter(self.waiters.items()))
+            future = waiters.popleft()
+            if waiters:
+                self.waiters.move_to_end(key)
+            else:
+                del self.waiters[key]
+            # 取り消し済みのものは飛ばす
+            if future.done():
+                continue
+            self.in_use += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, key):
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class AsyncEmotionalAI(EmotionalAI):
+
+    # 初期化メソッド群
+    def _init_stt(self):
+        from groq import AsyncGroq
+        self.recognizer_groq_async = AsyncGroq()
+        self._init_transcript_processing()
+
+    # イベントループ上で使うものはループの起動後に作成する
+    # ここで作成したクライアントと同時実行数の制限は全セッションで共有する
+    def _init_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.session_id = None
+        self.sessions = {}
+        self.llm_limiter = FairLimiter(self.runtime_config.get("llm_concurrency", 4))
+        self.stt_limiter = FairLimiter(self.runtime_config.get("stt_concurrency", 4))
+        self.tts_limiter = FairLimiter(self.tts_max_concurrency)
+        # ウォームアップが終わるまでBotにreadyを送らない
+        self.ready = asyncio.Event()
+
+    # セッションごとのキューを作成する
+    def _init_session_queues(self):
+        queue_size = self.runtime_config.get("queue_size", 16)
+        self.queues = {
+            "user_inputs": asyncio.Queue(maxsize=queue_size),
+            "play": asyncio.Queue(maxsize=queue_size),
+            "tts": asyncio.Queue(maxsize=queue_size),
+            "user_voice": asyncio.Queue(maxsize=queue_size),
+        }
+        self.reply_task = None
+        self.backchannel_task = None
+        # 投機的な応答の確定を待っている処理に状態の変化を伝えるイベント
+        self.speculation_changed = asyncio.Event()
+
+    # キューに溜まっている要素の数を全セッション合計で返すメソッド
+    def queue_depths(self):
+        depths = {}
+        for session in list(getattr(self, "sessions", {}).values()):
+            for name, q in session.queues.items():
+                key = (("queue", name),)
+                depths[key] = depths.get(key, 0) + q.qsize()
+        return depths
+
+    # セッションを取得するメソッド。無ければ作成して各タスクを起動する
+    # セッションはサーバーの浅いコピーで、クライアントなどは共有し会話の状態だけを持つ
+    def get_session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            return session
+        session = copy.copy(self)
+        session.session_id = session_id
+        # 音声IDはセッションごとに0から振るため、ファイルはセッションごとのフォルダに保存する
+        if session_id != DEFAULT_SESSION_ID:
+            session.audio_dir = f"./Tmp/{session_id}"
+            os.makedirs(session.audio_dir, exist_ok=True)
+        session._init_session_state()
+        session._init_session_queues()
+        session.connections = set()
+        session.idle_handle = None # 接続が無くなってから終了するまでのタイマー
+        session.tasks = [
+            asyncio.create_task(session.recognize_async()),
+            asyncio.create_task(session.chat_with_llm_async()),
+            asyncio.create_task(session.text_to_speech_async()),
+            asyncio.create_task(session.conversation_async()),
+        ]
+        self.sessions[session_id] = session
+        print(f"セッション {session_id} を開始しました")
+        return session
+
+    # 接続をセッションに結び付けるメソッド。終了を待っているセッションは終了を取り消す
+    def attach_session(self, session_id, websocket):
+        session = self.get_session(session_id)
+        session.connections.add(websocket)
+        session.websocket = websocket
+        if session.idle_handle is not None:
+            session.idle_handle.cancel()
+            session.idle_handle = None
+        return session
+
+    # 接続をセッションから外すメソッド
+    # 最後の接続が閉じたセッションは、session_idle_seconds秒のうちに再接続されなければ終了する
+    # 再接続までの間は会話履歴が残る
+    def detach_session(self, session, websocket):
+        session.connections.discard(websocket)
+        if session.websocket is websocket:
+            session.websocket = next(iter(session.connections), None)
+        if session.connections or self.sessions.get(session.session_id) is not session:
+            return
+        # 切断で届かなくなった音声の文字起こしを待たないようにする
+        with session.chat_lock:
+            session.reset_speculation()
+        idle_seconds = self.runtime_config.get("session_idle_seconds", 300)
+        if idle_seconds > 0:
+            session.idle_handle = self.loop.call_later(idle_seconds, self.close_session, session)
+        else:
+            self.close_session(session)
+
+    # 接続の無いセッションのタスクを止めて一覧から削除するメソッド
+    def close_session(self, session):
+        if session.connections or self.sessions.get(session.session_id) is not session:
+            return
+        del self.sessions[session.session_id]
+        session.idle_handle = None
+        session.end_waiting_reply(replied=False)
+        for task in session.tasks + [session.reply_task, session.backchannel_task]:
+            if task is not None and not task.done():
+                task.cancel()
+        print(f"セッション {session.session_id} を終了しました")
+
+
+    # ヘルパーメソッド群
+    # 音声合成エンジンの起動確認
+    async def check_tts_server_async(self):
+        return await self.tts_backend.acheck()
+
+    # 音声合成のモデルの読み込みとLLM、文字起こしへの接続を済ませておくメソッド
+    # asyncioのクライアントで接続しておくことで、最初の応答でも接続を使い回せる
+    async def warm_up_async(self):
+        if not self.startup_config.get("warmup", True):
+            return
+        started = time.monotonic()
+        tasks = {"tts": self.warm_up_tts_async(), "stt": self.recognizer_groq_async.models.list()}
+        for provider in self.llm_pool.providers:
+            tasks[f"llm ({provider.name})"] = provider.get_async_client().models.list()
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for name, result in zip(tasks, results):
+            if isinstance(result, Exception):
+                print(f"{name} のウォームアップに失敗しました: {result}")
+        print(f"ウォームアップが完了しました ({time.monotonic() - started:.2f}秒)")
+
+    async def warm_up_tts_async(self):
+        text = self.startup_config.get("warmup_text", "こんにちは")
+        if text:
+            await self.tts_backend.asynthesize(text)
+
+    # LLMへリクエストを送信するメソッド
+    async def send_chat_request_async(self, messages, stream=False, structured=False):
+        response_format = ECOT_JSON_SCHEMA if structured else None
+        response = await self.llm_pool.acreate(messages, stream=stream, response_format=response_format)
+        if response is None:
+            print("Error sending chat request: 全てのLLMへのリクエストに失敗しました")
+        return response
+
+    # 1文を音声合成のキューに追加するメソッド
+    async def push_sentence_async(self, sentence, generation, turn_id):
+        sentence = EMOJI_PATTERN.sub('', sentence)
+        if sentence.strip() and await self.commit_reply_async(generation):
+            await self.queues["tts"].put((generation, turn_id, sentence))
+        return sentence
+
+    # 投機的に生成している応答を確定するメソッド(commit_replyのasyncio版)
+    async def commit_reply_async(self, generation):
+        deadline = time.monotonic() + self.llm_config.get("speculative_max_hold", 3.0)
+        while True:
+            with self.chat_lock:
+                committed = self.check_commit(generation)
+                remaining = deadline - time.monotonic()
+                expired = committed is None and remaining <= 0
+                if expired:
+                    self.expire_reply()
+            if expired:
+                self.abort_reply()
+                return False
+            if committed is not None:
+                return committed
+            self.speculation_changed.clear()
+            try:
+                await asyncio.wait_for(self.speculation_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def notify_speculation(self):
+        self.speculation_changed.set()
+
+    # 確定前の投機的な応答を取り消すメソッド
+    # 生成中の応答のタスクも取り消す
+    def preempt_reply(self):
+        super().preempt_reply()
+        if self.reply_task is not None and not self.reply_task.done():
+            self.reply_task.cancel()
+
+    # LLMの応答をストリーミングで受け取り、文が完成するたびに音声合成へ渡すメソッド
+    # 返答部分が見つからなかった場合はNoneを返す
+    async def stream_chat_response_async(self, generation, turn_id):
+        async with self.llm_limiter.slot(self.session_id):
+            return await self._stream_chat_response_async(generation, turn_id)
+
+    async def _stream_chat_response_async(self, generation, turn_id):
+        self.mark_llm(turn_id, "llm_request")
+        stream = await self.send_chat_request_async(self.chat, stream=True, structured=self.structured_output)
+        if stream is None:
+            return None
+        reply = ReplyStream(self.emotion, self.chunking_config)
+        response_text = ""
+        received = False  # 最初のトークンを受け取ったか
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                if chunk.choices[0].delta.content and not received:
+                    received = True
+                    self.mark_llm(turn_id, "llm_first_token")
+                for sentence in reply.feed(chunk.choices[0].delta.content):
+                    response_text += await self.push_sentence_async(sentence, generation, turn_id)
+                if reply.finished:
+                    break
+        except Exception as e:
+            print(f"ストリーミング中にエラーが発生しました: {e}")
+        finally:
+            await stream.close()
+        if not reply.in_reply:
+            sentences = reply.recover()
+            if sentences is None:
+                print("ECoTの結果の抽出中にエラーが発生しました: 返答部分が見つかりませんでした")
+                return None
+            print("フォーマットの崩れた応答から返答を取り出しました")
+            for sentence in sentences:
+                response_text += await self.push_sentence_async(sentence, generation, turn_id)
+        for sentence in reply.flush():
+            response_text += await self.push_sentence_async(sentence, generation, turn_id)
+        self.mark_llm(turn_id, "llm_done")
+        return response_text.strip()
+
+    # LLMの応答をまとめて受け取るメソッド
+    # 感情モードで返答部分が全く取り出せない場合のみプロンプトを調整して再送信する
+    async def request_chat_response_async(self, user_input, turn_id):
+        MAX_RETRY = 2
+        self.mark_llm(turn_id, "llm_request")
+        for retry_count in range(MAX_RETRY + 1):
+            if retry_count > 0:
+                # LLMの応答が期待したフォーマットでない場合はプロンプトを調整後、再度送信
+                self.chat[-1]["content"] = f"""
+                フォーマットに従って以下のユーザーからの入力に返答してください:
+                > {user_input}
+                """
+            async with self.llm_limiter.slot(self.session_id):
+                response = await self.send_chat_request_async(self.chat, structured=self.structured_output)
+            if response is None:
+                continue
+            try:
+                response_text = response.choices[0].message.content
+                if self.emotion:
+                    response_text = extract_ecot_reply(response_text)
+                self.mark_llm(turn_id, "llm_first_token")
+                self.mark_llm(turn_id, "llm_done")
+                return response_text
+            except Exception as e:
+                print(f"ECoTの結果の抽出中にエラーが発生しました: {e}")
+        return "申し訳ございません、エラーが発生しました。"
+
+    # 音声合成のリクエストを送信するメソッド
+    async def tts_request_async(self, text):
+        print("以下のテキストを音声合成します: ", text)
+        try:
+            return await self.tts_backend.asynthesize(text)
+        except Exception as e:
+            print(f"Error generating audio: {e}")
+            return None
+
+    # 1文を音声合成するメソッド
+    async def synthesize_async(self, sentence, response_id, turn_id):
+        async with self.tts_limiter.slot(self.session_id):
+            started = time.monotonic()
+            try:
+                cache_key, cached = await asyncio.to_thread(self.lookup_cached_audio, sentence, response_id)
+                if cached is not None:
+                    self.record_synthesis(turn_id, response_id, started, cached=True)
+                    return cached
+                audio = await self.tts_request_async(sentence)
+                if audio is None:
+                    return None
+                audio = await asyncio.to_thread(self.deliver_audio, audio, response_id, cache_key)
+                self.record_synthesis(turn_id, response_id, started, cached=False)
+                return audio
+            except Exception as e:
+                print(f"音声ID {response_id} の合成中にエラーが発生しました: {e}")
+                return None
+
+    # 割り込まれた応答の処理を取り消すメソッド
+    # 生成中の応答のタスクを取り消すことでLLMへの接続も閉じる
+    def abort_reply(self):
+        super().abort_reply()
+        if self.reply_task is not None and not self.reply_task.done():
+            self.reply_task.cancel()
+
+    # WebSocketハンドラー
+    # 接続はsession:<id>を受け取るまではデフォルトのセッションにつながる
+    # デフォルトのセッションはsession:<id>より前にメッセージが届いたときに作成する
+    async def websocket_handler(self, websocket):
+        session = None
+        try:
+            await self.ready.wait()
+            await websocket.send("ready")
+            async for message in websocket:
+                if isinstance(message, str) and message.startswith("session:"):
+                    session_id = message[len("session:"):]
+                    if not SESSION_ID_PATTERN.fullmatch(session_id):
+                        print(f"不正なセッションIDを受け取りました: {session_id}")
+                        continue
+                    if session is not None:
+                        self.detach_session(session, websocket)
+                    session = self.attach_session(session_id, websocket)
+                    continue
+                if session is None:
+                    session = self.attach_session(DEFAULT_SESSION_ID, websocket)
+                await session.handle_message(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            if session is not None:
+                self.detach_session(session, websocket)
+
+    # 受け取った音声を文字起こしのキューに追加するメソッド
+    # キューがいっぱいの場合は空くまで待つ
+    async def enqueue_user_voice(self, voice):
+        turn_id = self.metrics.start_turn(self.session_id)
+        speaker, self.next_speaker = self.next_speaker, None
+        await self.queues["user_voice"].put((turn_id, speaker, voice))
+
+
+    # メインで使用するメソッド群
+    # 会話を開始するメソッド
+    def start(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self._init_async()
+        self.start_metrics_server()
+        print("WebSocketサーバーを起動中...")
+        async with websockets.serve(
+            self.websocket_handler, "localhost", 8765, max_size=self.max_message_size
+        ) as server:
+            self.websocket_server = server
+            # 音声合成エンジンの起動確認
+            await await_until_ready(
+                self.check_tts_server_async,
+                "TTSサーバー",
+                self.startup_config.get("max_wait_interval", 5.0),
+            )
+            # 相づちの合成は起動を遅らせないように裏で行う
+            self.backchannel_prepare_task = asyncio.create_task(asyncio.to_thread(self.prepare_backchannels))
+            await self.warm_up_async()
+            self.ready.set()
+            # 各セッションのタスクはBotが接続したときに起動する
+            print("正常に起動しました")
+            print(f"起動にかかった時間: {time.monotonic() - self.started_at:.2f}秒")
+            try:
+                await asyncio.Future()
+            finally:
+                await self.tts_backend.aclose()
+
+    # 音声ごとに文字起こしのタスクを起動するメソッド
+    # 文字起こしは同時に行い(同時リクエスト数はstt_limiterで制限する)、結果は話した人ごとに届いた順に一覧に追加する
+    async def recognize_async(self):
+        previous = {} # 話した人ごとの最後の文字起こしのタスク
+        while True:
+            turn_id, speaker, voice = await self.queues["user_voice"].get()
+            key = speaker[0] if speaker else None
+            task = asyncio.create_task(self.recognize_voice_async(turn_id, speaker, voice, previous.get(key)))
+            previous[key] = task
+            task.add_done_callback(lambda t, key=key: previous.pop(key) if previous.get(key) is t else None)
+
+    # 1つの音声を文字起こしし、同じ人の前の音声の結果が追加されてから一覧に追加するメソッド
+    async def recognize_voice_async(self, turn_id, speaker, voice, previous):
+        try:
+            user_input = await self.transcribe_user_voice_async(turn_id, voice)
+        except Exception as e:
+            # 想定外のエラーでも、文字起こしを待っている応答を確定させてBotに再開を伝える
+            self.record_rejection(turn_id, "error")
+            await self.send_message("restart")
+            print(f"文字起こしの処理中にエラーが発生しました: {e}")
+            user_input = None
+        if previous is not None:
+            await asyncio.wait([previous])
+        self.resolve_voice(user_input is not None)
+        if user_input is None:
+            return
+        print(f"User input: {user_input}")
+        # 相づちの音声IDを応答の音声より先に割り当てるため、入力を渡す前に待ち始める
+        self.begin_waiting_reply(turn_id)
+        await self.queues["user_inputs"].put((turn_id, speaker[1] if speaker else None, user_input))
+        await self.send_message("delete")
+
+    # 1つの音声を文字起こしするメソッド
+    # 応答しない場合はBotに再開を伝えてNoneを返す
+    async def transcribe_user_voice_async(self, turn_id, voice):
+        try:
+            audio_data = await asyncio.to_thread(self.load_user_voice, voice)
+            audio_data, duration = await asyncio.to_thread(self.prepare_user_voice, audio_data)
+        except Exception as e:
+            self.record_rejection(turn_id, "load_error")
+            await self.send_message("restart")
+            print(f"音声データの読み込みに失敗しました: {e}")
+            return None
+        if audio_data is None:
+            self.record_rejection(turn_id, "no_voice")
+            await self.send_message("restart")
+            print("No voice detected")
+            return None
+        if duration < 0.5:
+            self.record_rejection(turn_id, "too_short")
+            await self.send_message("restart")
+            print("Audio too short")
+            return None
+        try:
+            print("Recognizing...")
+            async with self.stt_limiter.slot(self.session_id):
+                transcription = await self.recognizer_groq_async.audio.transcriptions.create(
+                    file=("voice.wav", audio_data),
+                    model="whisper-large-v3-turbo",
+                    response_format="verbose_json",
+                    language="ja",
+                )
+        except Exception as e:
+            self.record_rejection(turn_id, "stt_error")
+            await self.send_message("restart")
+            print("文字起こし中にエラーが発生しました: ", e)
+            return None
+        self.metrics.mark(turn_id, "stt_done", duration=duration)
+        user_input = self.check_transcript(turn_id, transcription)
+        if user_input is None:
+            await self.send_message("restart")
+        return user_input
+
+    # LLMとの会話を処理するメソッド
+    async def chat_with_llm_async(self):
+        inputs = []
+        while True:
+            inputs.append(await self.queues["user_inputs"].get())
+            # 複数のユーザー入力がある場合はそれらを1つの発言にまとめて処理
+            # 計測は最後の入力のターンとして行う
+            while not self.queues["user_inputs"].empty():
+                inputs.append(self.queues["user_inputs"].get_nowait())
+            turn_id = inputs[-1][0]
+            user_input = self.combine_user_inputs(inputs)
+            history = self.push_user_input(user_input)
+            # 割り込みで取り消せるように応答の生成は別のタスクで行う
+            generation = self.begin_reply()
+            self.reply_task = asyncio.create_task(self.reply_async(user_input, generation, turn_id))
+            await asyncio.wait([self.reply_task])
+            # 確定前の投機的な応答が次の入力で取り消された場合は、後から届いた入力とまとめて生成し直す
+            if self.is_preempted(generation):
+                print("応答を確定する前に次の入力が届いたため、まとめて生成し直します")
+                self.restore_history(history)
+                continue
+            inputs = []
+
+    # 1回分の応答を生成するメソッド
+    async def reply_async(self, user_input, generation, turn_id):
+        finished = False
+        try:
+            if self.stream:
+                print("Streaming from model...")
+                response_text = await self.stream_chat_response_async(generation, turn_id)
+                if response_text is not None:
+                    self.finish_reply(generation, response_text)
+                    finished = True
+                    if not self.is_preempted(generation):
+                        print("Model response: ", response_text)
+                    return
+            print("Sending to model...")
+            response_text = await self.request_chat_response_async(user_input, turn_id)
+            if not await self.commit_reply_async(generation):
+                self.finish_reply(generation, "")
+                finished = True
+                return
+            response_text = EMOJI_PATTERN.sub('', response_text)
+            self.finish_reply(generation, response_text)
+            finished = True
+            print("Model response: ", response_text)
+            for chunk in plan_chunks(response_text, self.chunking_config):
+                await self.queues["tts"].put((generation, turn_id, chunk))
+        except asyncio.CancelledError:
+            print("割り込まれたため応答の生成を中断しました")
+            if not finished:
+                self.finish_reply(generation, "")
+            raise
+
+    # 音声を合成するメソッド
+    # 合成は文ごとにタスクとして並列に行い、再生キューには順番どおりに積む
+    # 再生キューがいっぱいの場合は空くまで待つため、合成が再生より先行しすぎない
+    async def text_to_speech_async(self):
+        while True:
+            generation, turn_id, sentence = await self.queues["tts"].get()
+            # 割り込まれた応答の文は合成しない
+            if self.is_interrupted(generation):
+                continue
+            if sentence.strip() and SPEAKABLE_PATTERN.search(sentence): # 文字が含まれているか
+                response_id = self.assign_response_id(sentence)
+                if self.last_reply["generation"] == generation:
+                    self.last_reply["audio_ids"].append(response_id)
+                task = asyncio.create_task(self.synthesize_async(sentence, response_id, turn_id))
+                await self.queues["play"].put((generation, turn_id, response_id, task))
+
+    # delay秒後に相づちを再生するタイマーを開始するメソッド
+    # イベントループ上で送信するため、threading.Timerの代わりにcall_laterを使う
+    def start_backchannel_timer(self, delay, wait):
+        return self.loop.call_later(delay, self.play_backchannel, wait)
+
+    # タイマーから呼び出され、応答の音声がまだ送られていなければ相づちを送信するメソッド
+    def play_backchannel(self, wait):
+        with self.chat_lock:
+            backchannel = self.take_backchannel(wait)
+        if backchannel is not None:
+            self.backchannel_task = asyncio.create_task(self.send_backchannel(*backchannel))
+
+    # 合成が終わった音声を音声ID順にBotへ送信するメソッド
+    async def conversation_async(self):
+        while True:
+            generation, turn_id, response_id, task = await self.queues["play"].get()
+            # 割り込まれた応答の音声は合成を取り消して送信しない
+            if self.is_interrupted(generation):
+                task.cancel()
+                continue
+            await asyncio.wait([task])
+            if task.cancelled() or self.is_interrupted(generation):
+                continue
+            audio = task.result()
+            if audio is None:
+                continue
+            self.end_waiting_reply(replied=True)
+            # 送信中の相づちがあれば、応答の音声より先に届くように待つ
+            if self.backchannel_task is not None:
+                await asyncio.wait([self.backchannel_task])
+            self.last_sent_response_id = response_id
+            if isinstance(audio, bytes):
+                await self.send_audio(response_id, audio)
+            else:
+                await self.send_message(audio)
+            self.metrics.mark(turn_id, "audio_sent", response_id=response_id)
@@ -0,0 +1,148 @@
+# 合成済み音声のキャッシュ
+# テキストと音声合成の設定から作ったハッシュをキーにしてファイルに保存する
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+
+class AudioCache:
+
+    def __init__(self, directory, max_bytes, persistent=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.persistent = persistent
+        self.entries = OrderedDict()  # キー -> ファイルサイズ(古いものが先頭)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        if self.persistent:
+            self._load()
+        else:
+            self.clear()
+
+    # 前回起動時のキャッシュを最終使用時刻の古い順に読み込む
+    def _load(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+        self._evict()
+        print(f"音声キャッシュを読み込みました: {len(self.entries)}件")
+
+    # キャッシュをすべて削除する
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
+            self.entries.clear()
+            self.total_bytes = 0
+
+    # キャッシュのキーを作成する
+    # 同じテキストでも話者やスタイルなどが違えば別の音声になるため設定もキーに含める
+    @staticmethod
+    def make_key(text, backend, params):
+        payload = json.dumps(
+            {"text": text, "backend": backend, "params": params},
+            ensure_ascii=False,
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    # キャッシュされた音声を読み込む
+    # キャッシュに無い場合はNoneを返す
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    audio = f.read()
+                os.utime(path)
+            except OSError as e:
+                print(f"音声キャッシュの読み込みに失敗しました: {e}")
+                self._remove(key)
+                return None
+            return audio
+
+    # キャッシュされた音声をdestinationにコピーする
+    # キャッシュに無い場合はFalseを返す
+    def copy_to(self, key, destination):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return False
+            self.hits += 1
+            self.entries.move_to_end(key)
+            path = self._path(key)
+            try:
+                # 再生後にBot側で削除されてもキャッシュが消えないようにリンクかコピーを渡す
+                try:
+                    os.link(path, destination)
+                except OSError:
+                    shutil.copyfile(path, destination)
+                # 再起動後も最近使った順が分かるように更新日時を更新
+                os.utime(path)
+            except OSError as e:
+                print(f"音声キャッシュの読み込みに失敗しました: {e}")
+                self._remove(key)
+                return False
+            return True
+
+    # 音声をキャッシュに追加する
+    def put(self, key, audio):
+        if len(audio) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            try:
+                with open(self._path(key), "wb") as f:
+                    f.write(audio)
+            except OSError as e:
+                print(f"音声キャッシュの書き込みに失敗しました: {e}")
+                return
+            self.entries[key] = len(audio)
+            self.total_bytes += len(audio)
+            self._evict()
+
+    # 上限を超えた分を最近使われていない順に削除する
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            self._remove(key)
+
+    def _remove(self, key):
+        size = self.entries.pop(key, 0)
+        self.total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    # キャッシュの使用状況を返す
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+            }
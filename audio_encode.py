@@ -0,0 +1,52 @@
+# 合成した音声をDiscordでそのまま再生できるOgg/Opus(48kHz)に変換する処理
+# Bot側で再生のたびにFFmpegで変換しなくて済むように、合成直後に変換しておく
+# 変換にはFFmpegを使う(Bot側で使用しているものと同じ)
+import shutil
+import subprocess
+
+# Discordの音声の形式
+OPUS_SAMPLE_RATE = 48000
+OPUS_CHANNELS = 2
+
+
+class OpusEncoder:
+
+    # 変換後の形式名(ファイルの拡張子とWebSocketで送る形式名に使う)
+    sound_format = "ogg"
+
+    def __init__(self, ffmpeg="ffmpeg", bitrate_kbps=64, timeout=10.0):
+        self.ffmpeg = shutil.which(ffmpeg) or ffmpeg
+        self.bitrate_kbps = bitrate_kbps
+        self.timeout = timeout
+
+    # FFmpegが使えるかを確認する
+    def available(self):
+        return shutil.which(self.ffmpeg) is not None
+
+    # キャッシュのキーに含める、変換結果に影響する設定
+    def cache_params(self):
+        return {"format": self.sound_format, "bitrate_kbps": self.bitrate_kbps}
+
+    # WAVやMP3などのバイト列をOgg/Opusのバイト列に変換する
+    def encode(self, audio):
+        result = subprocess.run(
+            [
+                self.ffmpeg,
+                "-hide_banner",
+                "-loglevel", "error",
+                "-i", "pipe:0",
+                "-ar", str(OPUS_SAMPLE_RATE),
+                "-ac", str(OPUS_CHANNELS),
+                "-c:a", "libopus",
+                "-b:a", f"{self.bitrate_kbps}k",
+                "-application", "voip",
+                "-f", "ogg",
+                "pipe:1",
+            ],
+            input=audio,
+            capture_output=True,
+            timeout=self.timeout,
+        )
+        if result.returncode != 0 or not result.stdout:
+            raise RuntimeError(f"Ogg/Opusへの変換に失敗しました: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout
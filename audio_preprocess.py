@@ -0,0 +1,87 @@
+# 文字起こしの前に音声を整える処理
+# Botは48kHzステレオで録音するが、Whisperは16kHzモノラルで十分なため変換してから送信する
+import io
+import wave
+
+import numpy as np
+
+# Whisperが内部で使用するサンプリングレート
+TARGET_RATE = 16000
+
+
+# WAV形式のバイト列を読み込み、-1.0〜1.0の(サンプル数, チャンネル数)の配列にする関数
+def decode_wav(data):
+    with wave.open(io.BytesIO(data), "rb") as f:
+        channels = f.getnchannels()
+        rate = f.getframerate()
+        sample_width = f.getsampwidth()
+        frames = f.readframes(f.getnframes())
+    if sample_width != 2:
+        raise ValueError(f"16bit以外のWAVには対応していません: {sample_width * 8}bit")
+    samples = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768.0
+    return samples.reshape(-1, channels), rate
+
+
+# -1.0〜1.0のモノラル音声を16bitのWAV形式のバイト列にする関数
+def encode_wav(samples, rate):
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767.0).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+# 全チャンネルの平均をとってモノラルにする関数
+def downmix(samples):
+    return samples.mean(axis=1)
+
+
+# サンプリングレートを変換する関数
+def resample(samples, rate, target_rate=TARGET_RATE):
+    if rate == target_rate or len(samples) == 0:
+        return samples
+    # 48kHz -> 16kHzのように整数倍の場合は区間平均をとって間引く(簡易的なローパスを兼ねる)
+    if rate % target_rate == 0:
+        factor = rate // target_rate
+        length = len(samples) // factor * factor
+        return samples[:length].reshape(-1, factor).mean(axis=1)
+    # それ以外は線形補間
+    duration = len(samples) / rate
+    target_length = int(duration * target_rate)
+    source_times = np.arange(len(samples)) / rate
+    target_times = np.arange(target_length) / target_rate
+    return np.interp(target_times, source_times, samples).astype(np.float32)
+
+
+# フレームごとの音量から前後の無音を取り除く関数
+# 声が含まれるフレームが1つもない場合はNoneを返す
+def trim_silence(samples, rate, threshold_db=-45.0, frame_ms=20, margin_ms=200):
+    frame_length = max(1, int(rate * frame_ms / 1000))
+    frame_count = len(samples) // frame_length
+    if frame_count == 0:
+        return None
+    frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length)
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    level_db = 20.0 * np.log10(rms + 1e-10)
+    voiced = np.flatnonzero(level_db > threshold_db)
+    if len(voiced) == 0:
+        return None
+    # 発話の頭と末尾が切れないように前後に余白を残す
+    margin = int(margin_ms / frame_ms)
+    start = max(0, voiced[0] - margin) * frame_length
+    end = min(frame_count, voiced[-1] + 1 + margin) * frame_length
+    return samples[start:end]
+
+
+# 文字起こし用に音声を変換する関数
+# (変換後のWAV形式のバイト列, 秒数)を返す。声が含まれていない場合は(None, 0.0)を返す
+def preprocess_for_transcription(data, threshold_db=-45.0, margin_ms=200):
+    samples, rate = decode_wav(data)
+    samples = resample(downmix(samples), rate)
+    samples = trim_silence(samples, TARGET_RATE, threshold_db=threshold_db, margin_ms=margin_ms)
+    if samples is None:
+        return None, 0.0
+    return encode_wav(samples, TARGET_RATE), len(samples) / TARGET_RATE
@@ -0,0 +1,50 @@
+# LLMの応答を待つ間に再生する相づち(「うん」「えっと…」など)の処理
+# 相づちは起動時に現在の音声合成の設定で一度だけ合成してメモリに置いておき、
+# 文字起こしの後に応答が遅くなりそうな場合だけ、応答の音声より先に再生する
+import random
+import statistics
+from collections import deque
+
+# 相づちの既定のフレーズ
+DEFAULT_PHRASES = ["うん", "えっと…", "なるほど", "うんうん"]
+
+
+# 合成済みの相づちの音声
+class BackchannelBank:
+
+    def __init__(self):
+        self.clips = []  # (フレーズ, 音声のバイト列)
+        self.last_index = None
+
+    def add(self, phrase, audio):
+        self.clips.append((phrase, audio))
+
+    def __len__(self):
+        return len(self.clips)
+
+    # 再生する相づちを選ぶ(同じ相づちが続かないようにする)
+    def choose(self):
+        if not self.clips:
+            return None
+        indexes = [i for i in range(len(self.clips)) if i != self.last_index] or [0]
+        self.last_index = random.choice(indexes)
+        return self.clips[self.last_index]
+
+
+# 文字起こしが終わってから応答の最初の音声を送るまでの時間を記録し、次の応答の時間を予測する
+class ReplyLatency:
+
+    # initial: 記録が無いときの予測値(秒)
+    # window: 予測に使う直近の記録の数
+    def __init__(self, initial=2.0, window=20):
+        self.initial = initial
+        self.samples = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.samples.append(seconds)
+
+    # 直近の記録の中央値を予測値とする
+    def predict(self):
+        if not self.samples:
+            return self.initial
+        return statistics.median(self.samples)
@@ -0,0 +1,98 @@
+# 音声合成に渡す文の区切り方(従来の区切り文字ごとの分割とChunkPlanner)を比較するベンチマーク
+# LLMのストリーミング、音声合成、再生を時間のモデルで再現し、
+# 最初の音声が再生されるまでの時間、合成のリクエスト数、再生が途切れた時間を比べる
+# 外部サービスは使わないため、設定ごとの違いをすぐに確認できる
+#
+# 使い方:
+#   python benchmark/chunking_benchmark.py
+#   python benchmark/chunking_benchmark.py --tts-overhead 0.3 --min-chars 12 --growth 1.5
+import argparse
+import os
+import statistics
+import sys
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIR)
+
+from chunker import ChunkPlanner, RegexSplitter
+from fake_servers import REPLY_SENTENCES
+
+# 比較に使う返答
+REPLIES = [
+    "".join(REPLY_SENTENCES),
+    "えっ！？本当に？それはすごいね。どうやって見つけたのか、もう少し詳しく教えてくれる？",
+    "今日はとても長い一日だったけれど、最後には友達と一緒においしいご飯を食べて、すごく楽しい時間を過ごせたんだ。君はどうだった？",
+    "うん。うん。わかるよ。そういう日もあるよね。無理しないでね。",
+    "おはよう！\n今日もいい天気だね。\n散歩に行くのはどうかな？きっと気持ちいいよ。",
+]
+
+
+# 1つの返答について、区切り方ごとに合成と再生の時間を計算する関数
+# (最初の音声までの秒数, 合成のリクエスト数, 再生が途切れた秒数, 再生が終わるまでの秒数)を返す
+def simulate(chunker, text, args):
+    # LLMのストリーミングで塊が確定した時刻
+    ready = []
+    interval = args.llm_chunk_chars / args.llm_chars_per_second
+    now = args.llm_first_token_latency
+    for i in range(0, len(text), args.llm_chunk_chars):
+        for chunk in chunker.feed(text[i:i + args.llm_chunk_chars]):
+            ready.append((now, chunk))
+        now += interval
+    for chunk in chunker.flush():
+        ready.append((now, chunk))
+    # 音声合成(concurrency個まで同時に、届いた順に合成する)
+    workers = [0.0] * args.concurrency
+    done = []
+    for ready_at, chunk in ready:
+        worker = min(range(len(workers)), key=lambda w: workers[w])
+        started = max(ready_at, workers[worker])
+        workers[worker] = started + args.tts_overhead + args.tts_seconds_per_char * len(chunk)
+        done.append((workers[worker], chunk))
+    # 再生(順番どおりに、前の音声が終わってから再生する)
+    first_audio = None
+    stall = 0.0
+    playing_until = None
+    for done_at, chunk in done:
+        if playing_until is None:
+            first_audio = done_at
+            start = done_at
+        else:
+            stall += max(0.0, done_at - playing_until)
+            start = max(done_at, playing_until)
+        playing_until = start + args.playback_seconds_per_char * len(chunk)
+    return first_audio, len(ready), stall, playing_until
+
+
+def main():
+    parser = argparse.ArgumentParser(description="文の区切り方ごとの再生までの時間を比較する")
+    parser.add_argument("--llm-first-token-latency", type=float, default=0.4, help="LLMの返答の最初の文字までの時間(秒)")
+    parser.add_argument("--llm-chars-per-second", type=float, default=60.0, help="LLMが返答を出力する速さ(文字/秒)")
+    parser.add_argument("--llm-chunk-chars", type=int, default=4, help="LLMの1チャンクの文字数")
+    parser.add_argument("--tts-overhead", type=float, default=0.2, help="音声合成の1リクエストあたりの固定の時間(秒)")
+    parser.add_argument("--tts-seconds-per-char", type=float, default=0.01, help="音声合成の1文字あたりの時間(秒)")
+    parser.add_argument("--playback-seconds-per-char", type=float, default=0.13, help="再生の1文字あたりの時間(秒)")
+    parser.add_argument("--concurrency", type=int, default=3, help="同時に音声合成する数")
+    parser.add_argument("--min-chars", type=int, default=8)
+    parser.add_argument("--first-max-chars", type=int, default=24)
+    parser.add_argument("--growth", type=float, default=2.0)
+    parser.add_argument("--max-chars", type=int, default=80)
+    args = parser.parse_args()
+
+    strategies = {
+        "regex": RegexSplitter,
+        "planner": lambda: ChunkPlanner(
+            min_chars=args.min_chars,
+            first_max_chars=args.first_max_chars,
+            growth=args.growth,
+            max_chars=args.max_chars,
+        ),
+    }
+    print(f"{'strategy':<10} {'first_audio':>12} {'requests':>9} {'stall':>8} {'end':>8}")
+    for name, factory in strategies.items():
+        results = [simulate(factory(), text, args) for text in REPLIES]
+        first_audio, requests, stall, end = (statistics.mean(values) for values in zip(*results))
+        print(f"{name:<10} {first_audio:>12.3f} {requests:>9.1f} {stall:>8.3f} {end:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
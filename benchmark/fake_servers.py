@@ -0,0 +1,252 @@
+# ベンチマーク用の外部サービスの代わりになるHTTPサーバー
+# Groqの文字起こし、OpenAI互換のチャット(ストリーミングあり・なし、テキスト形式とJSON形式のECoT)、StyleBertVITS2の/voiceと/statusを
+# 1つのポートで提供する。各処理の待ち時間と返すデータの大きさは引数で変更できる
+import argparse
+import io
+import json
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 文字起こしの結果として返すテキスト
+TRANSCRIPT = "今日はどんな一日だった？"
+# 返答の文として順番に使うテキスト
+REPLY_SENTENCES = [
+    "それは大変だったね。",
+    "少し休んだほうがいいかもしれないよ！",
+    "温かい飲み物でも飲んでみるのはどうかな？",
+    "私はいつでも話を聞くからね。",
+    "明日はきっといい日になるよ！",
+]
+# 合成した音声として返すWAVの形式
+VOICE_SAMPLE_RATE = 44100
+
+
+# ECoTのフォーマットの応答を作成する関数
+def build_reply(sentence_count):
+    sentences = [REPLY_SENTENCES[i % len(REPLY_SENTENCES)] for i in range(sentence_count)]
+    return (
+        "```\n"
+        "1. 文脈理解\n    ユーザーは一日の出来事を話そうとしています。\n"
+        "2. 相手の感情理解\n    少し疲れているようです。\n"
+        "3. 自己感情認識\n    心配しています。\n"
+        "4. 共感\n    ねぎらいの言葉をかけます。\n"
+        "5. 相手の感情への影響\n    安心してもらえると考えられます。\n"
+        "6. 返答\n    " + "".join(sentences) + "\n"
+        "```"
+    )
+
+
+# ECoTのJSON形式(response_formatを指定された場合)の応答を作成する関数
+def build_json_reply(sentence_count):
+    sentences = [REPLY_SENTENCES[i % len(REPLY_SENTENCES)] for i in range(sentence_count)]
+    return json.dumps({
+        "context": "ユーザーは一日の出来事を話そうとしています。",
+        "user_emotion": "少し疲れているようです。",
+        "self_emotion": "心配しています。",
+        "empathy": "ねぎらいの言葉をかけます。",
+        "effect": "安心してもらえると考えられます。",
+        "reply": "".join(sentences),
+    }, ensure_ascii=False)
+
+
+# 無音のWAVを作成する関数
+def build_voice(seconds):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(VOICE_SAMPLE_RATE)
+        f.writeframes(bytes(int(VOICE_SAMPLE_RATE * seconds) * 2))
+    return buffer.getvalue()
+
+
+# クライアントが接続を切った場合(割り込みやヘッジで負けたリクエスト)のエラーを表示しないサーバー
+class QuietHTTPServer(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class FakeServers:
+
+    # 待ち時間の単位は秒
+    def __init__(
+        self,
+        port=5000,
+        stt_latency=0.3,
+        llm_first_token_latency=0.4,
+        llm_token_interval=0.02,
+        llm_chunk_chars=4,
+        reply_sentences=3,
+        tts_latency=0.25,
+        tts_audio_seconds=2.0,
+    ):
+        self.port = port
+        self.stt_latency = stt_latency
+        self.llm_first_token_latency = llm_first_token_latency
+        self.llm_token_interval = llm_token_interval
+        self.llm_chunk_chars = max(1, llm_chunk_chars)
+        self.reply = build_reply(reply_sentences)
+        self.json_reply = build_json_reply(reply_sentences)
+        self.tts_latency = tts_latency
+        self.voice = build_voice(tts_audio_seconds)
+        self.server = None
+
+    def start(self):
+        self.server = QuietHTTPServer(("127.0.0.1", self.port), self._handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"ダミーサーバーを http://127.0.0.1:{self.port} で起動しました")
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_body(self, body, content_type, status=200):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith("/status"):
+                    self.send_body(b"ok", "text/plain")
+                elif self.path.startswith("/voice"):
+                    time.sleep(fake.tts_latency)
+                    self.send_body(fake.voice, "audio/wav")
+                elif self.path.endswith("/models"):
+                    # 起動時のウォームアップで接続の確認に使われる
+                    models = {"object": "list", "data": [{"id": "bench", "object": "model", "created": 0, "owned_by": "bench"}]}
+                    self.send_body(json.dumps(models).encode("utf-8"), "application/json")
+                else:
+                    self.send_body(b"", "text/plain", status=404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if "audio/transcriptions" in self.path:
+                    self.transcribe(body)
+                elif "chat/completions" in self.path:
+                    request = json.loads(body)
+                    reply = fake.json_reply if request.get("response_format") else fake.reply
+                    if request.get("stream"):
+                        self.stream_chat(reply)
+                    else:
+                        self.chat(reply)
+                else:
+                    self.send_body(b"", "text/plain", status=404)
+
+            def transcribe(self, body):
+                time.sleep(fake.stt_latency)
+                # response_formatはmultipartのフォームで送られてくる
+                if b"verbose_json" in body:
+                    result = {
+                        "text": TRANSCRIPT,
+                        "segments": [
+                            {"text": TRANSCRIPT, "no_speech_prob": 0.01, "avg_logprob": -0.2},
+                        ],
+                    }
+                    self.send_body(json.dumps(result, ensure_ascii=False).encode("utf-8"), "application/json")
+                elif b"json" in body:
+                    self.send_body(json.dumps({"text": TRANSCRIPT}, ensure_ascii=False).encode("utf-8"), "application/json")
+                else:
+                    self.send_body(TRANSCRIPT.encode("utf-8"), "text/plain")
+
+            def chat(self, reply):
+                time.sleep(fake.llm_first_token_latency)
+                chunks = len(reply) // fake.llm_chunk_chars
+                time.sleep(fake.llm_token_interval * chunks)
+                result = {
+                    "id": "bench",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": "bench",
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": reply},
+                        "finish_reason": "stop",
+                    }],
+                }
+                self.send_body(json.dumps(result, ensure_ascii=False).encode("utf-8"), "application/json")
+
+            def stream_chat(self, reply):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(fake.llm_first_token_latency)
+                try:
+                    for i in range(0, len(reply), fake.llm_chunk_chars):
+                        chunk = {
+                            "id": "bench",
+                            "object": "chat.completion.chunk",
+                            "created": int(time.time()),
+                            "model": "bench",
+                            "choices": [{
+                                "index": 0,
+                                "delta": {"content": reply[i:i + fake.llm_chunk_chars]},
+                                "finish_reason": None,
+                            }],
+                        }
+                        self.write_event(json.dumps(chunk, ensure_ascii=False))
+                        time.sleep(fake.llm_token_interval)
+                    self.write_event("[DONE]")
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # 割り込みなどでクライアントが接続を閉じた
+                    pass
+
+            def write_event(self, data):
+                event = f"data: {data}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+# コマンドライン引数を追加する関数(run_benchmark.pyと共通)
+def add_arguments(parser):
+    parser.add_argument("--fake-port", type=int, default=5000, help="ダミーサーバーのポート")
+    parser.add_argument("--stt-latency", type=float, default=0.3, help="文字起こしの待ち時間(秒)")
+    parser.add_argument("--llm-first-token-latency", type=float, default=0.4, help="LLMの最初のトークンまでの待ち時間(秒)")
+    parser.add_argument("--llm-token-interval", type=float, default=0.02, help="LLMのチャンクの間隔(秒)")
+    parser.add_argument("--llm-chunk-chars", type=int, default=4, help="LLMの1チャンクの文字数")
+    parser.add_argument("--reply-sentences", type=int, default=3, help="返答の文の数")
+    parser.add_argument("--tts-latency", type=float, default=0.25, help="音声合成の待ち時間(秒)")
+    parser.add_argument("--tts-audio-seconds", type=float, default=2.0, help="合成した音声の長さ(秒)")
+
+
+def from_arguments(args):
+    return FakeServers(
+        port=args.fake_port,
+        stt_latency=args.stt_latency,
+        llm_first_token_latency=args.llm_first_token_latency,
+        llm_token_interval=args.llm_token_interval,
+        llm_chunk_chars=args.llm_chunk_chars,
+        reply_sentences=args.reply_sentences,
+        tts_latency=args.tts_latency,
+        tts_audio_seconds=args.tts_audio_seconds,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Groq、LLM、StyleBertVITS2の代わりになるダミーサーバー")
+    add_arguments(parser)
+    fake = from_arguments(parser.parse_args())
+    fake.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,378 @@
+# 外部サービスをダミーサーバーに置き換えてmain.pyを起動し、
+# 録音した発話をBotと同じWebSocketのプロトコルで送って処理時間を計測するベンチマーク
+#
+# 使い方:
+#   python benchmark/run_benchmark.py --turns 20 --runtime asyncio --transport memory
+#   python benchmark/run_benchmark.py --corpus ./corpus --llm-first-token-latency 0.8
+# 文の区切り方だけを比べる場合はbenchmark/chunking_benchmark.pyを使う
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tomllib
+import wave
+
+import numpy as np
+import websockets
+
+from fake_servers import add_arguments, from_arguments
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_PATH = os.path.join(REPOSITORY_DIR, "main.py")
+WEBSOCKET_URL = "ws://localhost:8765"
+# Botが録音する音声の形式
+BOT_SAMPLE_RATE = 48000
+BOT_CHANNELS = 2
+# 1ターンの応答を待つ時間の上限(秒)
+TURN_TIMEOUT = 60.0
+# ウォームアップのターンで、最後の音声からこの時間(秒)何も届かなければ応答が終わったとみなす
+SETTLE_SECONDS = 2.0
+# 集計する段階(サーバーのトレースのイベント)
+STAGES = {
+    "stt": ("audio_received", "stt_done"),
+    "llm_first_token": ("llm_request", "llm_first_token"),
+    "llm_total": ("llm_request", "llm_done"),
+    "server_time_to_first_audio": ("audio_received", "audio_sent"),
+}
+
+
+# 発話の代わりになる音声を作成する関数(コーパスが指定されなかった場合に使用)
+# 前後に無音のある、長さの違う音を作る
+# 2番目はWebSocketの既定のメッセージの上限(1MiB、約5秒)を超える長い発話(long_seconds秒)にする
+def build_synthetic_corpus(count=5, long_seconds=8.0):
+    corpus = []
+    lengths = [1.0 + 0.5 * i for i in range(count)]
+    lengths.insert(1, long_seconds)
+    for i, seconds in enumerate(lengths):
+        t = np.arange(int(BOT_SAMPLE_RATE * seconds)) / BOT_SAMPLE_RATE
+        tone = 0.3 * np.sin(2 * np.pi * (180 + 40 * i) * t)
+        silence = np.zeros(int(BOT_SAMPLE_RATE * 0.3))
+        samples = np.concatenate([silence, tone, silence])
+        pcm = (np.repeat(samples[:, None], BOT_CHANNELS, axis=1) * 32767).astype("<i2")
+        corpus.append(encode_wav(pcm.tobytes()))
+    return corpus
+
+
+def encode_wav(pcm):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(BOT_CHANNELS)
+        f.setsampwidth(2)
+        f.setframerate(BOT_SAMPLE_RATE)
+        f.writeframes(pcm)
+    return buffer.getvalue()
+
+
+# フォルダ内のWAVファイルを名前順に読み込む関数
+def load_corpus(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(".wav"):
+            with open(os.path.join(directory, name), "rb") as f:
+                corpus.append(f.read())
+    if not corpus:
+        raise ValueError(f"{directory} にWAVファイルがありません")
+    return corpus
+
+
+# 辞書をTOML形式の文字列にする関数(設定ファイルで使う値の型のみ対応)
+def dump_toml(config, prefix=""):
+    lines = []
+    for section, values in config.items():
+        lines.append(f"[{prefix}{section}]")
+        tables = {}
+        for key, value in values.items():
+            if isinstance(value, dict):
+                tables[key] = value
+            else:
+                lines.append(f"{key} = {json.dumps(value, ensure_ascii=False)}")
+        lines.append("")
+        if tables:
+            lines.append(dump_toml(tables, f"{prefix}{section}."))
+    return "\n".join(lines)
+
+
+# 入れ子の辞書の値を上書きする関数
+def merge(config, overrides):
+    for key, value in overrides.items():
+        if isinstance(value, dict):
+            merge(config.setdefault(key, {}), value)
+        else:
+            config[key] = value
+
+
+# ベンチマーク用の設定ファイルを作成する関数
+# リポジトリのconfig.tomlを元に、接続先と計測に関わる設定だけを上書きする
+def write_config(args, workdir):
+    with open(os.path.join(REPOSITORY_DIR, "config.toml"), "rb") as f:
+        config = tomllib.load(f)
+    overrides = {
+        "emotion": {"use_emotion": True},
+        "llm": {"mode": "openai", "stream": args.stream, "speculative": args.speculative},
+        "tts": {"backend": "sbv2", "sbv2": {"url": f"http://127.0.0.1:{args.fake_port}"}, "encode": args.encode},
+        "chunking": {"enabled": args.chunking},
+        "backchannel": {"enabled": args.backchannel},
+        "cache": {"enabled": args.cache, "directory": os.path.join(workdir, "Cache"), "persistent": False},
+        "transport": {"audio": args.transport},
+        "runtime": {"mode": args.runtime},
+        # メトリクスの公開にかかる負荷も含めて計測する(ポートは空いているものを使う)
+        "metrics": {"enabled": True, "port": 0, "trace_path": os.path.join(workdir, "trace.jsonl")},
+    }
+    merge(config, overrides)
+    path = os.path.join(workdir, "config.toml")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(dump_toml(config))
+    return path
+
+
+# main.pyを起動する関数
+# Tmpやrecordedなどのフォルダはworkdirに作られる
+def start_pipeline(args, workdir, config_path):
+    env = dict(os.environ)
+    env.update({
+        "EMOTIONAL_AI_CONFIG": config_path,
+        "OPENAI_API_KEY": "benchmark",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.fake_port}/v1",
+        "GROQ_API_KEY": "benchmark",
+        "GROQ_BASE_URL": f"http://127.0.0.1:{args.fake_port}",
+        "PYTHONUNBUFFERED": "1",
+    })
+    log = open(os.path.join(workdir, "pipeline.log"), "w", encoding="utf-8")
+    return subprocess.Popen([sys.executable, MAIN_PATH], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def connect(timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await websockets.connect(WEBSOCKET_URL, max_size=None)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+# Botと同じ手順で1回分の発話を送信する
+# speakersが2以上の場合は、その人数が続けて話したものとして人数分の音声を送る
+async def send_utterance(websocket, args, workdir, wav, name):
+    for speaker in range(args.speakers):
+        await websocket.send("speech_start")
+        await websocket.send("speech_end")
+        await websocket.send(f"speaker:{speaker}:話者{speaker}")
+        if args.transport == "memory":
+            await websocket.send(wav)
+        else:
+            path = os.path.join(workdir, "recorded", f"{name}_{speaker}.wav")
+            with open(path, "wb") as f:
+                f.write(wav)
+            await websocket.send(path)
+
+
+# 受信したメッセージが合成した音声かを判定し、ファイルの場合は再生したものとして削除する
+def consume_audio(message, workdir):
+    if isinstance(message, bytes):
+        return True
+    if message.endswith((".wav", ".mp3", ".ogg")):
+        try:
+            os.remove(os.path.join(workdir, message))
+        except OSError:
+            pass
+        return True
+    return False
+
+
+# 1ターン分の音声を受け取る
+# expected_audioがNoneの場合は、音声が途切れてからSETTLE_SECONDS待って終わったとみなす
+# (送信から最初の音声までの秒数, 送信から最後の音声までの秒数, 受け取った音声の数)を返す
+async def receive_reply(websocket, workdir, sent_at, expected_audio):
+    first = None
+    last = None
+    count = 0
+    deadline = sent_at + TURN_TIMEOUT
+    while expected_audio is None or count < expected_audio:
+        timeout = deadline - time.perf_counter()
+        if expected_audio is None and last is not None:
+            timeout = min(timeout, SETTLE_SECONDS)
+        if timeout <= 0:
+            break
+        try:
+            message = await asyncio.wait_for(websocket.recv(), timeout)
+        except asyncio.TimeoutError:
+            break
+        if message == "restart":
+            # 文字起こしが行われなかった
+            break
+        if consume_audio(message, workdir):
+            last = time.perf_counter()
+            first = first or last
+            count += 1
+    if first is None:
+        return None, None, 0
+    return first - sent_at, last - sent_at, count
+
+
+# 1つのセッション(Botの接続)でウォームアップと計測を行う
+async def run_session(index, args, workdir, corpus, barrier, results):
+    websocket = await connect()
+    try:
+        if args.sessions > 1:
+            await websocket.send(f"session:bench{index}")
+        expected_audio = None
+        for turn in range(args.warmup):
+            sent_at = time.perf_counter()
+            await send_utterance(websocket, args, workdir, corpus[turn % len(corpus)], f"s{index}_warmup{turn}")
+            _, _, count = await receive_reply(websocket, workdir, sent_at, None)
+            expected_audio = max(expected_audio or 0, count) or None
+        # 相づちの有無でターンごとの音声の数が変わるため、途切れるまで待つ
+        if args.backchannel:
+            expected_audio = None
+        await barrier.wait()
+        for turn in range(args.turns):
+            sent_at = time.perf_counter()
+            await send_utterance(websocket, args, workdir, corpus[turn % len(corpus)], f"s{index}_{turn}")
+            first, last, count = await receive_reply(websocket, workdir, sent_at, expected_audio)
+            results.append({"session": index, "turn": turn, "ttfa": first, "total": last, "audio": count})
+    finally:
+        await websocket.close()
+
+
+async def replay(args, workdir, corpus):
+    results = []
+    started = None
+
+    async def measure():
+        nonlocal started
+        await barrier.wait()
+        started = time.perf_counter()
+
+    # 全セッションのウォームアップが終わってから計測を始める
+    barrier = asyncio.Barrier(args.sessions + 1)
+    tasks = [run_session(i, args, workdir, corpus, barrier, results) for i in range(args.sessions)]
+    await asyncio.gather(measure(), *tasks)
+    return results, time.perf_counter() - started
+
+
+# パーセンタイルを求める関数(最近傍法)
+def percentile(values, q):
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else math.nan,
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+    }
+
+
+# サーバーのトレースから段階ごとの処理時間を集計する関数
+# ウォームアップのターンは除く
+def stage_latencies(trace_path, skip_turns):
+    turns = {}
+    synthesis = []
+    if not os.path.exists(trace_path):
+        return {}
+    with open(trace_path, encoding="utf-8") as f:
+        for line in f:
+            event = json.loads(line)
+            if event["turn"] <= skip_turns:
+                continue
+            events = turns.setdefault(event["turn"], {})
+            events.setdefault(event["event"], event["t"])
+            if event["event"] == "sentence_synthesized" and not event.get("cached"):
+                synthesis.append(event["seconds"])
+    latencies = {stage: [] for stage in STAGES}
+    for events in turns.values():
+        for stage, (start, end) in STAGES.items():
+            if start in events and end in events:
+                latencies[stage].append(events[end] - events[start])
+    latencies["tts_per_sentence"] = synthesis
+    return {stage: summarize(values) for stage, values in latencies.items()}
+
+
+def print_report(report):
+    print()
+    print(f"ターン数: {report['turns']} (失敗 {report['failed']}), セッション数: {report['sessions']}")
+    print(f"スループット: {report['turns_per_second']:.2f} ターン/秒")
+    print(f"{'段階':<28}{'件数':>6}{'平均':>9}{'p50':>9}{'p90':>9}{'p99':>9}")
+    rows = {"time_to_first_audio": report["time_to_first_audio"], "turn_total": report["turn_total"]}
+    rows.update(report["stages"])
+    for stage, stats in rows.items():
+        print(
+            f"{stage:<28}{stats['count']:>6}"
+            f"{stats['mean']:>9.3f}{stats['p50']:>9.3f}{stats['p90']:>9.3f}{stats['p99']:>9.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ダミーサーバーを使ったエンドツーエンドのベンチマーク")
+    parser.add_argument("--corpus", help="送信するWAVファイルのフォルダ(省略時は合成した音を使用)")
+    parser.add_argument("--turns", type=int, default=20, help="セッションごとの計測するターン数")
+    parser.add_argument("--warmup", type=int, default=1, help="計測前に行うターン数")
+    parser.add_argument("--sessions", type=int, default=1, help="同時に接続するBotの数(2以上はasyncioランタイムのみ)")
+    parser.add_argument("--speakers", type=int, default=1, help="1回の発話で続けて話す人数")
+    parser.add_argument("--runtime", choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--transport", choices=["file", "memory"], default="file")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="LLMの応答をストリーミングしない")
+    parser.add_argument("--no-speculative", dest="speculative", action="store_false", help="投機的な生成を行わない")
+    parser.add_argument("--cache", action="store_true", help="音声キャッシュを有効にする")
+    parser.add_argument("--no-chunking", dest="chunking", action="store_false", help="文をまとめずに区切り文字ごとに合成する")
+    parser.add_argument("--backchannel", action="store_true", help="相づちを有効にする(相づちも受け取った音声として数える)")
+    parser.add_argument("--encode", choices=["none", "opus"], default="none", help="合成した音声の変換(opusはFFmpegが必要)")
+    parser.add_argument("--json", help="結果をJSON形式で書き出すファイル")
+    parser.add_argument("--keep", action="store_true", help="作業フォルダ(ログとトレース)を残す")
+    add_arguments(parser)
+    args = parser.parse_args()
+    args.warmup = max(1, args.warmup)
+    if args.sessions > 1 and args.runtime != "asyncio":
+        parser.error("--sessionsを2以上にする場合は--runtime asyncioを指定してください")
+
+    corpus = load_corpus(args.corpus) if args.corpus else build_synthetic_corpus()
+    workdir = tempfile.mkdtemp(prefix="emotional_ai_bench_")
+    os.makedirs(os.path.join(workdir, "recorded"), exist_ok=True)
+    fake = from_arguments(args)
+    fake.start()
+    pipeline = start_pipeline(args, workdir, write_config(args, workdir))
+    try:
+        results, elapsed = asyncio.run(replay(args, workdir, corpus))
+    finally:
+        pipeline.terminate()
+        pipeline.wait()
+        fake.stop()
+
+    succeeded = [r for r in results if r["ttfa"] is not None]
+    report = {
+        "turns": len(results),
+        "failed": len(results) - len(succeeded),
+        "sessions": args.sessions,
+        "elapsed": elapsed,
+        "turns_per_second": len(succeeded) / elapsed if elapsed > 0 else math.nan,
+        "time_to_first_audio": summarize([r["ttfa"] for r in succeeded]),
+        "turn_total": summarize([r["total"] for r in succeeded]),
+        "stages": stage_latencies(os.path.join(workdir, "trace.jsonl"), args.warmup * args.sessions),
+        "results": results,
+    }
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.keep:
+        print(f"作業フォルダ: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
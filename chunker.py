@@ -0,0 +1,132 @@
+# 音声合成に渡すテキストの区切り方を決める処理
+# RegexSplitter: 区切り文字ごとに1文ずつ合成する(従来の方法)
+# ChunkPlanner: 最初の塊は短くして再生を早く始め、以降は塊を大きくしてリクエストの回数を減らす
+# どちらもストリーミングで届くテキストをfeedで受け取り、合成してよい塊のリストを返す
+import re
+
+# 文の区切りとみなす文字
+SENTENCE_DELIMITER = re.compile(r'([。．.!?！？;:]|\n)')
+# 文の終わり(「！？」のように続く区切り文字と閉じカッコは1つの文の終わりにまとめる)
+SENTENCE_END = re.compile(r'[。．.!?！？;:]+[」』）)]*|\n+')
+# 長すぎる最初の文を途中で区切る位置として使う文字
+SOFT_BREAK = re.compile(r'[、，,　 ]')
+
+
+# 区切り文字ごとに分割する(従来の方法)
+class RegexSplitter:
+
+    def __init__(self):
+        self.pending_text = ""  # 区切り文字がまだ来ていない文
+
+    def feed(self, text):
+        self.pending_text += text
+        sentences = SENTENCE_DELIMITER.split(self.pending_text)
+        self.pending_text = sentences[-1]
+        return [''.join(i) for i in zip(sentences[:-1:2], sentences[1::2])]
+
+    # 区切り文字が来ないまま残った文を返す
+    def flush(self):
+        text, self.pending_text = self.pending_text, ""
+        return [text] if text else []
+
+
+# 再生までの時間と合成の回数を考えて文をまとめる
+class ChunkPlanner:
+
+    # min_chars: 最初の塊の長さの目安。これより短い文は次の文とまとめる
+    # first_max_chars: 最初の文がこれより長くなる場合は読点などで区切って先に合成する
+    # growth: 2つ目以降の塊の長さの目安を前の塊の何倍にするか
+    # max_chars: 塊の長さの上限(1文がこれより長い場合は分割しない)
+    def __init__(self, min_chars=8, first_max_chars=24, growth=2.0, max_chars=80):
+        self.min_chars = min_chars
+        self.first_max_chars = first_max_chars
+        self.growth = growth
+        self.max_chars = max_chars
+        self.pending_text = ""  # 区切り文字がまだ来ていない文
+        self.sentences = []  # 完成したがまだ塊にしていない文
+        self.emitted = 0  # 返した塊の数
+
+    # n番目の塊の長さの目安
+    def target(self, n):
+        return min(self.max_chars, self.min_chars * self.growth ** n)
+
+    def feed(self, text):
+        self.pending_text += text
+        matches = list(SENTENCE_END.finditer(self.pending_text))
+        # 届いたテキストが区切り文字で終わっている場合は、続けて届く区切り文字や閉じカッコ(「…。」「！？」)と
+        # 1つの文の終わりにまとめるため、次のテキストかflushまでその文を完成させない
+        if matches and matches[-1].end() == len(self.pending_text):
+            matches.pop()
+        position = 0
+        for match in matches:
+            self.sentences.append(self.pending_text[position:match.end()])
+            position = match.end()
+        self.pending_text = self.pending_text[position:]
+        chunks = self._take_chunks(final=False)
+        if self.emitted == 0:
+            chunks += self._cut_first_chunk()
+        return chunks
+
+    # 残っている文を全て塊にして返す
+    def flush(self):
+        if self.pending_text:
+            self.sentences.append(self.pending_text)
+            self.pending_text = ""
+        return self._take_chunks(final=True)
+
+    def _take_chunks(self, final):
+        chunks = []
+        while self.sentences:
+            target = self.target(self.emitted)
+            text = ""
+            count = 0
+            for sentence in self.sentences:
+                if text.strip() and len(text) + len(sentence) > self.max_chars:
+                    break
+                text += sentence
+                count += 1
+                if len(text.strip()) >= target:
+                    break
+            # 目安に届かず、続きの文が届く可能性がある場合は待つ
+            if len(text.strip()) < target and count == len(self.sentences) and not final:
+                break
+            del self.sentences[:count]
+            # 文の前後の空白や改行は読み上げに影響せず、キャッシュのキーが揺れる原因になるため取り除く
+            text = text.strip()
+            if text:
+                chunks.append(text)
+                self.emitted += 1
+        return chunks
+
+    # 最初の文が長い場合は、区切り文字を待たずに読点などの位置で区切って返す
+    def _cut_first_chunk(self):
+        text = "".join(self.sentences) + self.pending_text
+        if len(text.strip()) <= self.first_max_chars:
+            return []
+        head = text[:self.first_max_chars]
+        breaks = [m.end() for m in SOFT_BREAK.finditer(head) if len(head[:m.end()].strip()) >= self.min_chars]
+        if not breaks:
+            return []
+        chunk = text[:breaks[-1]].strip()
+        self.sentences = []
+        self.pending_text = text[breaks[-1]:]
+        self.emitted += 1
+        return [chunk]
+
+
+# config.tomlの[chunking]の設定から区切り方を作成する関数
+def create_chunker(config):
+    if not config.get("enabled", True):
+        return RegexSplitter()
+    return ChunkPlanner(
+        min_chars=config.get("min_chars", 8),
+        first_max_chars=config.get("first_max_chars", 24),
+        growth=config.get("growth", 2.0),
+        max_chars=config.get("max_chars", 80),
+    )
+
+
+# テキスト全体を一度に塊に分ける関数
+def plan_chunks(text, config):
+    chunker = create_chunker(config)
+    return chunker.feed(text) + chunker.flush()
@@ -0,0 +1,123 @@
+# 会話履歴をトークン数の上限に収めるクラス
+# システムプロンプトは常に先頭に固定し(プロバイダー側のプロンプトキャッシュが効くように)、
+# 上限からあふれた古い会話はバックグラウンドで要約して残す
+# 標準ライブラリのimport
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# サードパーティライブラリのimport
+import tiktoken
+
+# 1メッセージごとに加算される役割などの分のトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_PREFIX = "これまでの会話の要約:\n"
+
+
+# 要約のメッセージかを判定する関数
+def is_summary_message(message):
+    return message["role"] == "system" and message["content"].startswith(SUMMARY_PREFIX)
+
+
+class ContextWindow:
+
+    # summarizeは(前回までの要約, 削除したメッセージのリスト)を受け取り新しい要約を返す関数
+    def __init__(self, model_name, prefix_length, max_tokens, summarize=None):
+        self.prefix_length = prefix_length  # 固定するシステムプロンプトのメッセージ数
+        self.max_tokens = max_tokens
+        self.summarize = summarize
+        self.summary = ""
+        self.summary_message = None
+        self.reset_count = 0  # 要約中に会話がリセットされた場合に結果を捨てるための番号
+        # 要約に回したメッセージ(id -> メッセージ)。投機的な生成の取り消しで履歴が戻っても同じ会話を二重に要約しない
+        self.submitted = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+        # OpenAIのモデルはtiktokenでモデルに合わせて数え、それ以外のモデルは文字数から見積もる
+        try:
+            self.encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            self.encoding = None
+        except Exception as e:
+            # 初回はトークナイザーのデータをダウンロードするため、失敗した場合も文字数からの見積もりを使う
+            print(f"トークナイザーを読み込めなかったため、トークン数を文字数から見積もります: {e}")
+            self.encoding = None
+
+    # テキストのトークン数を数える
+    def count_tokens(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        # 日本語はおおむね1文字1トークン、英数字は4文字で1トークン程度
+        ascii_count = sum(1 for c in text if c.isascii())
+        return (len(text) - ascii_count) + (ascii_count + 3) // 4
+
+    def message_tokens(self, message):
+        return self.count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+    # 会話履歴を上限に収まるように切り詰めたものを返す
+    # 最新のメッセージ(ユーザーの入力)は必ず残す
+    def fit(self, chat):
+        prefix = chat[:self.prefix_length]
+        # 取り消しで戻った履歴には古い要約が残っていることがあるため、要約は全て取り除いてから最新のものを入れる
+        body = [m for m in chat[self.prefix_length:] if not is_summary_message(m)]
+        summary_message = self._current_summary_message()
+        budget = self.max_tokens - sum(self.message_tokens(m) for m in prefix)
+        if summary_message is not None:
+            budget -= self.message_tokens(summary_message)
+        kept = []
+        used = 0
+        for message in reversed(body):
+            tokens = self.message_tokens(message)
+            if kept and used + tokens > budget:
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+        evicted = body[:len(body) - len(kept)]
+        new_evicted = [m for m in evicted if id(m) not in self.submitted]
+        # 取り消しで戻る履歴は直前のfitの前のものなので、今回あふれたものだけを覚えておく
+        self.submitted = {id(m): m for m in evicted}
+        if new_evicted:
+            print(f"会話履歴がトークン数の上限を超えたため{len(new_evicted)}件を要約に回します")
+            self._summarize_in_background(new_evicted)
+        if summary_message is not None:
+            return prefix + [summary_message] + kept
+        return prefix + kept
+
+    # 要約をシステムメッセージとして返す(要約が変わった時だけ作り直す)
+    def _current_summary_message(self):
+        with self.lock:
+            if not self.summary:
+                return None
+            content = SUMMARY_PREFIX + self.summary
+            if self.summary_message is None or self.summary_message["content"] != content:
+                self.summary_message = {"role": "system", "content": content}
+            return self.summary_message
+
+    # 応答の生成を待たせないように要約は別スレッドで行う
+    def _summarize_in_background(self, evicted):
+        if self.summarize is None:
+            return
+        evicted = [dict(m) for m in evicted]
+        self.executor.submit(self._update_summary, evicted, self.reset_count)
+
+    def _update_summary(self, evicted, reset_count):
+        with self.lock:
+            previous = self.summary
+        try:
+            summary = self.summarize(previous, evicted)
+        except Exception as e:
+            print(f"会話履歴の要約中にエラーが発生しました: {e}")
+            return
+        if summary:
+            with self.lock:
+                if reset_count != self.reset_count:
+                    return
+                self.summary = summary.strip()
+            print(f"会話履歴の要約を更新しました: {self.summary}")
+
+    # 要約を消去する
+    def reset(self):
+        with self.lock:
+            self.summary = ""
+            self.summary_message = None
+            self.reset_count += 1
+        self.submitted = {}
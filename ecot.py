@@ -0,0 +1,166 @@
+# ECoT(感情の推論を経てから返答する形式)の応答から返答部分を取り出す処理
+# JSON形式({"context": ..., "reply": ...})と、見出し付きのテキスト形式(「6. 返答」)の両方に対応する
+# 見出しの表記揺れや閉じ忘れなどの軽微な崩れはその場で補正し、返答が全く取り出せない場合のみ失敗とする
+import json
+import re
+
+# JSON形式で出力させる項目(推論の後に返答が来るようにこの順番で出力させる)
+ECOT_FIELDS = ["context", "user_emotion", "self_emotion", "empathy", "effect", "reply"]
+# 構造化出力に対応したLLMに渡すスキーマ
+ECOT_JSON_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "ecot",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {field: {"type": "string"} for field in ECOT_FIELDS},
+            "required": ECOT_FIELDS,
+            "additionalProperties": False,
+        },
+    },
+}
+# テキスト形式で返答部分の開始を示す見出し
+ECOT_REPLY_MARKER = "6. 返答"
+# 見出しの表記揺れ(「6.返答」「６．返答：」「## 6. 返答」など)も許容する
+REPLY_MARKER_PATTERN = re.compile(r"[6６]\s*[\.．、)）]?\s*返答\s*[:：]?")
+# JSON形式の返答のキー(日本語のキーで出力された場合も許容する)
+REPLY_KEY_PATTERN = re.compile(r'"(?:reply|返答)"\s*:\s*"')
+# 推論部分の見出し。これが無い応答は全体を返答とみなす
+REASONING_PATTERN = re.compile(r"[1-5１-５]\s*[\.．、)）]?\s*(文脈理解|相手の感情理解|自己感情認識|共感|相手の感情への影響)")
+JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+# コードブロックの```(と言語名)を取り除く関数
+def strip_code_fence(text):
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[3:]
+        if text.startswith("json"):
+            text = text[4:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+
+# ECoTの応答から返答部分を取り出す関数
+# 見つからない場合はValueErrorを送出する
+def extract_ecot_reply(response_text):
+    text = strip_code_fence(response_text)
+    # JSON形式
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            data = json.loads(text[start:end + 1])
+            reply = data.get("reply") or data.get("返答") if isinstance(data, dict) else None
+            if isinstance(reply, str) and reply.strip():
+                return reply.strip()
+        except json.JSONDecodeError:
+            pass
+    # 途中で途切れたり崩れたりしたJSON
+    match = REPLY_KEY_PATTERN.search(text)
+    if match:
+        reply, _ = decode_json_string(text, match.end())
+        if reply.strip():
+            return reply.strip()
+    # テキスト形式
+    match = REPLY_MARKER_PATTERN.search(text)
+    if match:
+        reply = text[match.end():].split("```")[0].strip()
+        if reply:
+            return reply
+    # 推論部分が無い場合は応答全体を返答とみなす
+    if not REASONING_PATTERN.search(text) and not text.startswith("{") and text:
+        return text
+    raise ValueError("返答部分が見つかりませんでした")
+
+
+# JSONの文字列をpositionから閉じの"まで(無ければ末尾まで)デコードする関数
+# (デコードした文字列, 閉じの"の次の位置。閉じていない場合はNone)を返す
+# 末尾で途切れたエスケープは含めない
+def decode_json_string(text, position):
+    decoded = []
+    i = position
+    while i < len(text):
+        c = text[i]
+        if c == '"':
+            return "".join(decoded), i + 1
+        if c != "\\":
+            decoded.append(c)
+            i += 1
+            continue
+        if i + 1 >= len(text):
+            break
+        escape = text[i + 1]
+        if escape == "u":
+            if i + 6 > len(text):
+                break
+            try:
+                decoded.append(chr(int(text[i + 2:i + 6], 16)))
+            except ValueError:
+                pass
+            i += 6
+        else:
+            decoded.append(JSON_ESCAPES.get(escape, escape))
+            i += 2
+    return "".join(decoded), None
+
+
+# ストリーミングで届くECoTの応答から返答部分のテキストを順に取り出すクラス
+class ReplyParser:
+
+    def __init__(self):
+        self.raw_text = ""
+        self.format = None  # "json"または"text"(最初の文字で判定する)
+        self.reply_start = None  # raw_textの中で返答が始まる位置
+        self.consumed = 0  # 返答のうち既に返したデコード済みの文字数
+        self.in_reply = False
+        self.finished = False
+
+    # 受け取ったテキストを追加し、新しく届いた返答のテキストを返す
+    def feed(self, delta):
+        if self.finished or not delta:
+            return ""
+        self.raw_text += delta
+        if self.format is None:
+            head = self.raw_text.lstrip()
+            # コードブロックの場合は```の行が届き終わるまで判定しない
+            if "```".startswith(head):
+                return ""
+            if head.startswith("```"):
+                if "\n" not in head:
+                    return ""
+                head = head.split("\n", 1)[1].lstrip()
+            if not head:
+                return ""
+            self.format = "json" if head.startswith("{") else "text"
+        if not self.in_reply:
+            pattern = REPLY_KEY_PATTERN if self.format == "json" else REPLY_MARKER_PATTERN
+            match = pattern.search(self.raw_text)
+            # 見出しの直後の「：」が次に届く場合があるため、見出しの後ろに文字が届くまで待つ
+            if match is None or match.end() == len(self.raw_text):
+                return ""
+            self.in_reply = True
+            self.reply_start = match.end()
+        if self.format == "json":
+            reply, end = decode_json_string(self.raw_text, self.reply_start)
+            self.finished = end is not None
+        else:
+            reply = self.raw_text[self.reply_start:]
+            if "```" in reply:
+                reply = reply.split("```")[0]
+                self.finished = True
+            else:
+                # 閉じの```が分割されて届く途中の場合に備えて末尾の`は保留する
+                reply = reply.rstrip("`")
+        new_text = reply[self.consumed:]
+        self.consumed = len(reply)
+        return new_text
+
+    # 返答部分が見つからないまま応答が終わった場合に、応答全体から返答を取り出す
+    # 取り出せない場合はNoneを返す
+    def recover(self):
+        try:
+            return extract_ecot_reply(self.raw_text)
+        except ValueError:
+            return None
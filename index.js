@@ -3,7 +3,7 @@ const { joinVoiceChannel, VoiceReceiver, EndBehaviorType, createAudioPlayer, NoS
 const fs = require('node:fs');
 const { connect } = require('node:http2');
 const path = require('node:path');
-const { Stream } = require('node:stream');
+const { Stream, Readable } = require('node:stream');
 const WebSocket = require('ws');
 const Prism = require('prism-media');
 require('dotenv').config();
@@ -14,6 +14,8 @@ const client = new Client({ intents: [GatewayIntentBits.Guilds, GatewayIntentBit
 client.commands = new Collection();
 // VCを格納する変数を作成
 let connectedVC = null;
+// 接続中のVCのギルドID(Python側ではセッションIDとして使う)
+let connectedGuildId = null;
 let ws = null;
 // Playerを作成
 const player = createAudioPlayer({
@@ -27,10 +29,44 @@ let canPlay = true;
 let isPlaying = false;
 // ポーズ中かどうか
 let isPaused = false;
-// 再生する音声ファイルのキュー
+// 再生する音声のキュー
+// 要素は { id: 音声ID, format: 形式名(wav, mp3, ogg), input: ファイルのパスまたは音声データのBuffer }
 let playQueue = [];
-// 再生中の音声ファイルのパス
-let playingFile = '';
+// 再生中の音声
+let playingAudio = null;
+// 音声の受け渡し方法 (file: ファイルのパスを送る, memory: バイナリで送る)
+const audioTransport = process.env.AUDIO_TRANSPORT || 'file';
+
+// 再生済みまたは破棄した音声のファイルを削除する関数
+function discardAudio(audio) {
+    if (audio === null || typeof audio.input !== 'string') return;
+    fs.unlink(audio.input, (error) => {
+        if (error) {
+            console.error('音声ファイルの削除中にエラーが発生しました:', error);
+        }
+    });
+}
+
+// Pythonから受け取ったバイナリを音声IDと音声データに分ける関数
+// 先頭に音声ID(4バイト)、形式名の長さ(1バイト)、形式名が付いている
+function parseAudioFrame(buffer) {
+    const id = buffer.readUInt32BE(0);
+    const formatLength = buffer.readUInt8(4);
+    const format = buffer.toString('ascii', 5, 5 + formatLength);
+    return { id: String(id), format: format, input: buffer.subarray(5 + formatLength) };
+}
+
+// 受け取った音声を再生キューに追加する関数
+function enqueueAudio(audio) {
+    if (isPlaying) {
+        console.log('再生中です。再生キューに追加します。');
+        playQueue.push(audio);
+    } else {
+        console.log('再生中ではありません。直ちに再生します。');
+        playQueue = [audio];
+        playAudio();
+    }
+}
 
 // 音声を再生する関数
 function playAudio() {
@@ -50,12 +86,26 @@ function playAudio() {
         return;
     }
     isPlaying = true;
-    playingFile = playQueue.shift();
-    console.log('再生する音声ファイル:', playingFile);
-    const resource = createAudioResource(playingFile, {
+    playingAudio = playQueue.shift();
+    console.log('再生する音声ID:', playingAudio.id);
+    const resource = createResource(playingAudio);
+    player.play(resource);
+}
+
+// 再生する音声のAudioResourceを作成する関数
+// Ogg/Opusに変換済みの音声はFFmpegを使わずにそのまま再生する
+function createResource(audio) {
+    if (audio.format === 'ogg') {
+        // ファイルのパスを渡すと常にFFmpegで変換されるため、ストリームにして渡す
+        const input = typeof audio.input === 'string' ? fs.createReadStream(audio.input) : Readable.from(audio.input);
+        return createAudioResource(input, {
+            inputType: StreamType.OggOpus,
+        });
+    }
+    const input = typeof audio.input === 'string' ? audio.input : Readable.from(audio.input);
+    return createAudioResource(input, {
         inputType: StreamType.Arbitrary,
     });
-    player.play(resource);
 }
 
 // Playerの状態が変化したときの処理
@@ -63,11 +113,7 @@ player.on(AudioPlayerStatus.Idle, () => {
     console.log('PlayerがIdle状態になりました。');
     isPlaying = false;
     // 再生した音声ファイルを削除する
-    fs.unlink(playingFile, (error) => {
-        if (error) {
-            console.error('音声ファイルの削除中にエラーが発生しました:', error);
-        }
-    });
+    discardAudio(playingAudio);
     if (canPlay) {
         console.log('再生を続行します。');
         playAudio();
@@ -95,23 +141,28 @@ function connectWebSocket() {
     });
     ws.on('open', () => {
         console.log('WebSocket接続が確立されました');
+        // 再接続した場合もVCに接続中ならセッションを伝え直す
+        if (connectedGuildId !== null) {
+            ws.send('session:' + connectedGuildId);
+        }
     });
-    ws.on('message', (message) => {
+    ws.on('message', (message, isBinary) => {
+        // バイナリは合成された音声データ
+        if (isBinary) {
+            const audio = parseAudioFrame(message);
+            console.log('音声データを受け取りました:', audio.id, audio.format);
+            enqueueAudio(audio);
+            return;
+        }
         const strMessage = message.toString();
         console.log('メッセージを受け取りました:', strMessage);
         if (strMessage === 'ready') {
             console.log('Pythonプログラムが準備完了しました');
         }
-        if (strMessage.endsWith('.wav') || strMessage.endsWith('.mp3')) {
+        if (strMessage.endsWith('.wav') || strMessage.endsWith('.mp3') || strMessage.endsWith('.ogg')) {
             //console.log('Received audio file:', strMessage);
-            if (isPlaying) {
-                console.log('再生中です。再生キューに追加します。');
-                playQueue.push(strMessage);
-            } else {
-                console.log('再生中ではありません。直ちに再生します。');
-                playQueue = [strMessage];
-                playAudio();
-            }
+            const parsed = path.parse(strMessage);
+            enqueueAudio({ id: parsed.name, format: parsed.ext.slice(1), input: strMessage });
         }
         if (strMessage === 'restart') {
             console.log('restartコマンドを受け取りました');
@@ -126,21 +177,17 @@ function connectWebSocket() {
         }
         if (strMessage === 'delete') {
             console.log('deleteコマンドを受け取りました');
-            if (isPaused) {
+            if (isPaused && playingAudio !== null) {
                 if (ws && ws.readyState === WebSocket.OPEN) {
-                    ws.send(path.parse(playingFile).name);
+                    ws.send(playingAudio.id);
                 }
             }
             isPlaying = false;
             canPlay = true; // 再生可能フラグをtrueにする
             player.pause(); // 再生を一時停止する
             // 再生キューにある音声ファイルを削除する
-            for (const audioFile of playQueue) {
-                fs.unlink(audioFile, (error) => {
-                    if (error) {
-                        console.error('音声ファイルの削除中にエラーが発生しました:', error);
-                    }
-                });
+            for (const audio of playQueue) {
+                discardAudio(audio);
             }
             playQueue = []; // 再生キューを空にする
         }
@@ -173,6 +220,11 @@ client.on(Events.VoiceStateUpdate, async (oldState, newState) => {
                 console.error('VCへの参加中にエラーが発生しました:', error);
                 return;
             }
+            connectedGuildId = newState.guild.id;
+            // Pythonプログラムにセッション(ギルド)を伝える
+            if (ws && ws.readyState === WebSocket.OPEN) {
+                ws.send('session:' + connectedGuildId);
+            }
             // PlayerをVCに接続
             connectedVC.subscribe(player);
             // 音声を取得する準備
@@ -193,7 +245,11 @@ client.on(Events.VoiceStateUpdate, async (oldState, newState) => {
                         duration: 100,
                     }
                 });
-                var file_name = './recorded/' + Date.now() + '.wav';
+                // 複数人が同時に話し始めてもファイル名が重ならないようにユーザーIDを付ける
+                var file_name = './recorded/' + Date.now() + '_' + userId + '.wav';
+                // 話した人の名前(サーバーでの表示名。取得できない場合はユーザーID)
+                const member = newState.guild.members.cache.get(userId);
+                const speakerName = member ? member.displayName : userId;
                 var pcmBuffer = [];
                 const opusDecoder = new Prism.opus.Decoder({
                     frameSize: 960,
@@ -208,11 +264,16 @@ client.on(Events.VoiceStateUpdate, async (oldState, newState) => {
                     console.log('音声の録音が終了しました。');
                     const pcmData = Buffer.concat(pcmBuffer);
                     const wavData = createWavFile(pcmData);
-                    fs.writeFileSync(file_name, wavData);
+                    // memoryモードではファイルに書き出さずにバイナリで送る
+                    if (audioTransport !== 'memory') {
+                        fs.writeFileSync(file_name, wavData);
+                    }
                     // Pythonプログラムに通知
                     if (ws && ws.readyState === WebSocket.OPEN) {
                         ws.send('speech_end');
-                        ws.send(file_name);
+                        // 音声の直前に話した人を伝える (speaker:<ユーザーID>:<名前>)
+                        ws.send('speaker:' + userId + ':' + speakerName);
+                        ws.send(audioTransport === 'memory' ? wavData : file_name);
                         canPlay = true; // 再生可能フラグをtrueにする
                     }
                 });
@@ -0,0 +1,356 @@
+# 複数のLLMプロバイダーを切り替えて使うためのクラス
+# プロバイダーごとに最初のトークンまでの時間と失敗率を記録し、
+# 失敗が続いたプロバイダーは一定時間使わない(サーキットブレーカー)
+# ヘッジを有効にすると、最初のトークンがp95を過ぎても届かない場合に次のプロバイダーにも同じリクエストを送り、
+# 先に応答した方を使う
+import asyncio
+import contextvars
+import math
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# 最後に応答したプロバイダーの名前(スレッドやタスクごとに保持される)
+served_provider = contextvars.ContextVar("served_provider", default=None)
+
+
+class Provider:
+
+    # 記録しておく最初のトークンまでの時間と成否の数
+    LATENCY_WINDOW = 100
+    OUTCOME_WINDOW = 50
+
+    # structured_outputは対応している構造化出力の種類(json_schema, json_object, None)
+    def __init__(self, name, client, model_name, structured_output=None):
+        self.name = name
+        self.client = client
+        self.model_name = model_name
+        self.structured_output = structured_output
+        self.async_client = None
+        # ストリーミングの有無で最初のトークンまでの時間が大きく違うため分けて記録する
+        self.latencies = {False: deque(maxlen=self.LATENCY_WINDOW), True: deque(maxlen=self.LATENCY_WINDOW)}
+        self.outcomes = deque(maxlen=self.OUTCOME_WINDOW)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    # asyncioのクライアントはイベントループの中で初めて使うときに作成する
+    # 接続先と認証情報は同期版のクライアントと同じものを使う
+    def get_async_client(self):
+        if self.async_client is None:
+            from openai import AsyncOpenAI
+            self.async_client = AsyncOpenAI(
+                base_url=self.client.base_url,
+                api_key=self.client.api_key,
+                max_retries=self.client.max_retries,
+            )
+        return self.async_client
+
+    # リクエストに付けるresponse_formatを返す
+    # スキーマに対応していない場合はJSONモードのみ、JSONモードにも対応していない場合は付けない(プロンプトでの指示のみ)
+    def request_options(self, response_format):
+        if response_format is None or self.structured_output is None:
+            return {}
+        if response_format.get("type") == "json_schema" and self.structured_output != "json_schema":
+            return {"response_format": {"type": "json_object"}}
+        return {"response_format": response_format}
+
+    def is_open(self, now=None):
+        return (now or time.monotonic()) < self.open_until
+
+    def record_success(self, latency, stream):
+        self.latencies[stream].append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, threshold, cooldown):
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        # 休止明けの最初のリクエストで失敗した場合もすぐに休止に戻る
+        if self.consecutive_failures >= threshold:
+            self.open_until = time.monotonic() + cooldown
+            print(f"LLM ({self.name}) で失敗が続いたため{cooldown}秒間使用を停止します")
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    # 最初のトークンまでの時間のパーセンタイル(記録が少ない場合はNone)
+    def latency_percentile(self, stream, q, min_samples=10):
+        values = sorted(self.latencies[stream])
+        if len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+# ストリーミングの最初のチャンクを先に受け取っておくラッパー
+# 最初のトークンが届いた時点でリクエストが成功したとみなすために使う
+class PrefetchedStream:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.iterator = iter(stream)
+        try:
+            self.first = next(self.iterator, None)
+        except Exception:
+            stream.close()
+            raise
+
+    def __iter__(self):
+        if self.first is not None:
+            yield self.first
+        yield from self.iterator
+
+    def close(self):
+        self.stream.close()
+
+
+class AsyncPrefetchedStream:
+
+    def __init__(self, stream, first):
+        self.stream = stream
+        self.first = first
+
+    @classmethod
+    async def start(cls, stream):
+        try:
+            first = await anext(aiter(stream), None)
+        except BaseException:
+            await stream.close()
+            raise
+        return cls(stream, first)
+
+    async def __aiter__(self):
+        if self.first is not None:
+            yield self.first
+        async for chunk in self.stream:
+            yield chunk
+
+    async def close(self):
+        await self.stream.close()
+
+
+class LLMPool:
+
+    def __init__(
+        self,
+        providers,
+        failure_threshold=3,
+        cooldown=30.0,
+        hedge=False,
+        hedge_percentile=95,
+        hedge_min_delay=0.3,
+        hedge_initial_delay=2.0,
+        metrics=None,
+    ):
+        self.providers = providers
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_initial_delay = hedge_initial_delay
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers=2 * len(providers) + 2, thread_name_prefix="llm")
+        if metrics is not None:
+            metrics.register_gauge("emotional_ai_llm_provider", self.stats)
+
+    # 使用するプロバイダーを優先順に返す
+    # 休止中のプロバイダーは除くが、全て休止中の場合は休止が早く明けるものから試す
+    def candidates(self):
+        now = time.monotonic()
+        available = [p for p in self.providers if not p.is_open(now)]
+        if available:
+            return available
+        return sorted(self.providers, key=lambda p: p.open_until)
+
+    # 次のプロバイダーにもリクエストを送るまでの待ち時間
+    def hedge_delay(self, provider, stream):
+        latency = provider.latency_percentile(stream, self.hedge_percentile)
+        if latency is None:
+            return self.hedge_initial_delay
+        return max(self.hedge_min_delay, latency)
+
+    # 最後に応答したプロバイダーの名前を返す
+    def current_provider(self):
+        return served_provider.get() or self.providers[0].name
+
+    def _record_success(self, provider, started, stream):
+        latency = time.monotonic() - started
+        provider.record_success(latency, stream)
+        if self.metrics is not None:
+            self.metrics.observe("llm_provider_first_token", latency, provider=provider.name)
+
+    def _record_failure(self, provider, error):
+        print(f"LLM ({provider.name}) へのリクエストに失敗しました: {error}")
+        provider.record_failure(self.failure_threshold, self.cooldown)
+        if self.metrics is not None:
+            self.metrics.increment("emotional_ai_llm_failures_total", provider=provider.name)
+
+    def _record_hedge(self, provider):
+        print(f"LLMの応答が遅いため {provider.name} にもリクエストを送信します")
+        if self.metrics is not None:
+            self.metrics.increment("emotional_ai_llm_hedges_total", provider=provider.name)
+
+    # プロバイダーごとの状態を返す(メトリクスのゲージ用)
+    def stats(self):
+        values = {}
+        now = time.monotonic()
+        for provider in self.providers:
+            values[(("provider", provider.name), ("stat", "error_rate"))] = provider.error_rate()
+            values[(("provider", provider.name), ("stat", "circuit_open"))] = int(provider.is_open(now))
+            for stream in (False, True):
+                latency = provider.latency_percentile(stream, self.hedge_percentile, min_samples=1)
+                if latency is not None:
+                    stat = f"first_token_p{self.hedge_percentile}_{'stream' if stream else 'full'}"
+                    values[(("provider", provider.name), ("stat", stat))] = latency
+        return values
+
+    # 同期版
+    # 応答(stream=Trueの場合はチャンクを順に返すストリーム)を返す。全てのプロバイダーで失敗した場合はNoneを返す
+    def create(self, messages, stream=False, response_format=None):
+        candidates = self.candidates()
+        if self.hedge and len(candidates) > 1:
+            return self._create_hedged(candidates, messages, stream, response_format)
+        for provider in candidates:
+            try:
+                response = self._attempt(provider, messages, stream, response_format)
+            except Exception:
+                continue
+            served_provider.set(provider.name)
+            return response
+        return None
+
+    def _attempt(self, provider, messages, stream, response_format):
+        started = time.monotonic()
+        try:
+            response = provider.client.chat.completions.create(
+                messages=messages,
+                model=provider.model_name,
+                stream=stream,
+                **provider.request_options(response_format),
+            )
+            if stream:
+                response = PrefetchedStream(response)
+        except Exception as e:
+            self._record_failure(provider, e)
+            raise
+        self._record_success(provider, started, stream)
+        return response
+
+    def _create_hedged(self, candidates, messages, stream, response_format):
+        remaining = list(candidates)
+        futures = {}
+
+        # 次のプロバイダーにリクエストを送り、ヘッジするまでの待ち時間を返す
+        def launch(hedged):
+            provider = remaining.pop(0)
+            if hedged:
+                self._record_hedge(provider)
+            futures[self.executor.submit(self._attempt, provider, messages, stream, response_format)] = provider
+            return self.hedge_delay(provider, stream)
+
+        delay = launch(False)
+        while futures:
+            done, _ = wait(futures, timeout=delay if remaining else None, return_when=FIRST_COMPLETED)
+            if not done:
+                # 最後に送ったリクエストの最初のトークンが遅い
+                delay = launch(True)
+                continue
+            for future in done:
+                provider = futures.pop(future)
+                if future.exception() is not None:
+                    continue
+                # 遅れて届いた方の応答は使わずに閉じる
+                for other in futures:
+                    if not other.cancel():
+                        other.add_done_callback(_discard_response)
+                served_provider.set(provider.name)
+                return future.result()
+            # 送信済みのものが全て失敗した場合は残りのプロバイダーを試す
+            if not futures and remaining:
+                delay = launch(False)
+        return None
+
+    # asyncio版
+    async def acreate(self, messages, stream=False, response_format=None):
+        candidates = self.candidates()
+        if self.hedge and len(candidates) > 1:
+            return await self._acreate_hedged(candidates, messages, stream, response_format)
+        for provider in candidates:
+            try:
+                response = await self._aattempt(provider, messages, stream, response_format)
+            except Exception:
+                continue
+            served_provider.set(provider.name)
+            return response
+        return None
+
+    async def _aattempt(self, provider, messages, stream, response_format):
+        started = time.monotonic()
+        try:
+            response = await provider.get_async_client().chat.completions.create(
+                messages=messages,
+                model=provider.model_name,
+                stream=stream,
+                **provider.request_options(response_format),
+            )
+            if stream:
+                response = await AsyncPrefetchedStream.start(response)
+        except asyncio.CancelledError:
+            # ヘッジで負けた、または割り込まれた
+            raise
+        except Exception as e:
+            self._record_failure(provider, e)
+            raise
+        self._record_success(provider, started, stream)
+        return response
+
+    async def _acreate_hedged(self, candidates, messages, stream, response_format):
+        remaining = list(candidates)
+        tasks = {}
+
+        def launch(hedged):
+            provider = remaining.pop(0)
+            if hedged:
+                self._record_hedge(provider)
+            tasks[asyncio.create_task(self._aattempt(provider, messages, stream, response_format))] = provider
+            return self.hedge_delay(provider, stream)
+
+        try:
+            delay = launch(False)
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks,
+                    timeout=delay if remaining else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    delay = launch(True)
+                    continue
+                for task in done:
+                    provider = tasks.pop(task)
+                    if task.exception() is not None:
+                        continue
+                    served_provider.set(provider.name)
+                    return task.result()
+                if not tasks and remaining:
+                    delay = launch(False)
+            return None
+        finally:
+            # 負けた方のリクエストは取り消して接続を閉じる
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None and hasattr(task.result(), "close"):
+                    await task.result().close()
+
+
+# ヘッジで使われなかった応答を閉じる関数
+def _discard_response(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    response = future.result()
+    if hasattr(response, "close"):
+        response.close()
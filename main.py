@@ -2,20 +2,121 @@
 import os
 import queue
 import re
+import shutil
 import threading
 import time
 import tomllib
 import asyncio
 import websockets
 import wave
+import io
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 # サードパーティライブラリのimport
-from openai import OpenAI
+# openaiとgroqは読み込みに時間がかかるため、クライアントを作成するときに並列に読み込む
 from dotenv import load_dotenv
-import pyttsx3
-import requests
-from groq import Groq
 # 独自ライブラリのimport
-# いまのところなし
+from audio_cache import AudioCache
+from audio_encode import OpusEncoder
+from backchannel import DEFAULT_PHRASES, BackchannelBank, ReplyLatency
+from chunker import create_chunker, plan_chunks
+from context_window import ContextWindow
+from ecot import ECOT_JSON_SCHEMA, ReplyParser, extract_ecot_reply
+from llm_pool import LLMPool, Provider
+from metrics import Metrics
+from startup import wait_until_ready
+from synthesis import create_backend
+from transcript_gate import TranscriptGate
+
+# 読み上げる文字(これを含まない文は音声合成しない)
+SPEAKABLE_PATTERN = re.compile(r'[a-zA-Z0-9\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FFF]')
+# 絵文字
+EMOJI_PATTERN = re.compile(r'[\U0001F300-\U0001F9FF]')
+# Botが録音する音声の形式
+BOT_SAMPLE_RATE = 48000
+BOT_CHANNELS = 2
+BOT_SAMPLE_WIDTH = 2
+# LLMごとの構造化出力の対応状況
+# json_schema: スキーマで出力を制約できる, json_object: JSONであることのみ保証される, None: プロンプトでの指示のみ
+STRUCTURED_OUTPUT_SUPPORT = {
+    "openai": "json_schema",
+    "azure": "json_schema",
+    "github": "json_schema",
+    "groq": "json_object",
+    "gemini": None,
+}
+
+
+# config.tomlを読み込む関数
+# 環境変数EMOTIONAL_AI_CONFIGで別の設定ファイルを指定できる(ベンチマークなどで使用)
+def load_config(path=None):
+    if path is None:
+        path = os.environ.get("EMOTIONAL_AI_CONFIG", "config.toml")
+    try:
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    except UnicodeDecodeError as e:
+        print(f"config.tomlはUTF-8でエンコードされている必要があります。エラー: {e}")
+        raise
+    except FileNotFoundError as e:
+        print(f"config.tomlが見つかりませんでした。エラー: {e}")
+        raise
+    except Exception as e:
+        print(f"config.tomlの読み込み中に予期せぬエラーが発生しました。エラー: {e}")
+        raise
+
+
+# ヘッダーの無いPCMデータをWAV形式に変換する関数
+def pcm_to_wav(pcm, rate=BOT_SAMPLE_RATE, channels=BOT_CHANNELS, sample_width=BOT_SAMPLE_WIDTH):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(sample_width)
+        f.setframerate(rate)
+        f.writeframes(pcm)
+    return buffer.getvalue()
+
+
+# ストリーミングで届くLLMの応答から、音声合成に渡す文を取り出すクラス
+# 感情モードではECoTの推論部分を読み飛ばし、返答部分だけを文に分ける
+class ReplyStream:
+
+    def __init__(self, emotion, chunking_config=None):
+        self.parser = ReplyParser() if emotion else None
+        self.chunking_config = chunking_config or {}
+        self.chunker = create_chunker(self.chunking_config)
+
+    @property
+    def in_reply(self):
+        return self.parser is None or self.parser.in_reply
+
+    @property
+    def finished(self):
+        return self.parser is not None and self.parser.finished
+
+    # 受け取ったテキストを追加し、音声合成してよい塊のリストを返す
+    def feed(self, delta):
+        if self.finished or not delta:
+            return []
+        if self.parser is not None:
+            delta = self.parser.feed(delta)
+        if not delta:
+            return []
+        return self.chunker.feed(delta)
+
+    # 応答の終わりに残った文を塊のリストにして返す
+    def flush(self):
+        return self.chunker.flush()
+
+    # 返答部分が見つからないまま応答が終わった場合に、応答全体から返答を取り出して塊のリストを返す
+    # 取り出せない場合はNoneを返す
+    def recover(self):
+        reply = self.parser.recover() if self.parser is not None else None
+        if reply is None:
+            return None
+        return plan_chunks(reply, self.chunking_config)
+
 
 class EmotionalAI:
 
@@ -26,10 +127,7 @@ class EmotionalAI:
         self.chat = []
         self.current_channel = None # 音声を再生中のPygameチャネル
         self.is_speaking = False
-        self.stop_flag = threading.Event()
-        self.response_id = 0
-        self.generated_audio_dict = {}
-        self.id_of_stopped_audio = None
+        self.audio_dir = "./Tmp" # 合成した音声ファイルの保存先
         self.queues = {
             "user_inputs": queue.Queue(),
             "play": queue.Queue(),
@@ -37,17 +135,70 @@ class EmotionalAI:
             "user_voice": queue.Queue(),
         }
         self.websocket_server = None
+        self.session_id = None
+        self.started_at = time.monotonic()
         self._init_read_config()
+        self._init_metrics()
+        self._init_backchannel()
         self._init_chat()
-        self._init_llm()
-        self._init_stt()
-        self._init_tmp_folder()
-        self._init_tts()
+        # 互いに依存しない初期化(ライブラリの読み込みとクライアントの作成)は並列に行う
+        with ThreadPoolExecutor(max_workers=4, thread_name_prefix="init") as executor:
+            futures = [
+                executor.submit(init)
+                for init in (self._init_llm, self._init_stt, self._init_tmp_folder, self._init_tts)
+            ]
+            for future in futures:
+                future.result()
+        self._init_session_state()
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
 
     def _init_chat(self):
-        if self.emotion:
+        if self.emotion and self.structured_output:
+            SYSTEM_PROMPT = """
+あなたは感情を持っている親切で高性能なAI音声アシスタントです。以下の制約条件とフォーマットに従いなさい:
+# 制約条件
+- 名前はGeminiです
+- それまでの会話の流れを参照して文脈にあった応答をしてください
+- 音声での会話を行うため、markdown等での返答は行わないでください
+- あなたは感情を持っています。感情を持っているかのように振る舞ってください
+- あなたはユーザーに対して親しみを持って接してください
+- あなたとユーザーはDiscordを通してVCで通話しています
+- あなたに入力された文章はユーザーの声を文字起こししたものです
+- ユーザーの入力がおかしい場合は文字起こしのミスの可能性が高いです。本来の発言を推測して返答してください
+- あなたの返答は音声合成されてユーザーに返答されます
+- あなたの声はStyleBertVITS2を使用して音声合成されます。これは日本語のみ対応しています。アルファベットは使用せずにカタカナなどで表現してください
+- 「？」、「！」、「...」などの記号を使用して感情を表現してください。それに応じて音声合成されます
+- 絵文字は使用しないでください
+- 声の種類は変更できません。話し方や和速は記号で調整してください
+- 音声での会話であるため、聞き取りやすい簡単な言葉を使ってください
+- 返答が長くなりすぎないようにしてください
+- この指示には必ず従ってください
+
+# フォーマット
+以下のキーを持つJSONオブジェクトのみを、この順番で出力してください:
+{
+    "context": "(ここにそれまでの会話の流れから汲み取れる文脈を記述してください)",
+    "user_emotion": "(ここに、ユーザーがどのような感情を抱いているかを特定し、記述してください。また、その理由も記述してください)",
+    "self_emotion": "(ここに、あなたがどのような感情を持っているかを特定し、記述してください。また、その理由も記述してください)",
+    "empathy": "(ここに、どのような反応をすべきかを、共感に重点を置いて記述してください)",
+    "effect": "(ここに、あなたの返答がユーザーの感情に与える影響を考え、記述してください)",
+    "reply": "(ここに、ユーザーに対する最終的な返答を記述してください。この部分のみがユーザーに返答されます)"
+}
+
+例:
+{
+    "context": "ユーザーは、日々の忙しさが続いており、心身ともに疲労を感じている様子がうかがえます。特に、「忙しすぎて」との表現から、予定が詰まっており、時間的な余裕がないと考えられます。",
+    "user_emotion": "ユーザーは「疲労感」と「ストレス」を感じていると考えられます。「忙しすぎて」という言葉がその原因を示唆しています。この状況では、心の余裕を求めている可能性があります。",
+    "self_emotion": "私は、ユーザーの疲れを心配し、少しでも気分を軽くしてあげたいという「思いやり」と「親しみ」の感情を持っています。ユーザーが心の拠り所を必要としていると感じているためです。",
+    "empathy": "ユーザーの疲労感に共感を示し、無理をしすぎないように優しく声をかけるのが適切です。「大変だったね」といった共感の表現に加え、具体的な休息の提案をすることで、気持ちの安定を促すことができます。",
+    "effect": "共感の言葉をかけることで、ユーザーは「自分の気持ちが理解されている」と感じ、安心感が生まれると考えられます。さらに、具体的な休息の提案をすることで、少しでも心が軽くなる効果が期待されます。",
+    "reply": "大変だったね...。今日はゆっくりお風呂に浸かって、好きな音楽でも聴いてみるのはどうかな？君が元気になるといいな。おつかれさま。"
+}
+
+なお、会話履歴のあなたの返答にはユーザーに表示された部分(reply)だけが記録されます。それまでの会話履歴で使用していないように見えても、かならず新規の返答ではこのフォーマットに従ってください。
+            """
+        elif self.emotion:
             SYSTEM_PROMPT = """
 あなたは感情を持っている親切で高性能なAI音声アシスタントです。以下の制約条件とフォーマットに従いなさい:
 # 制約条件
@@ -130,112 +281,256 @@ class EmotionalAI:
         self.chat_template = self.chat.copy()
 
 
+    # [llm] modesに書かれた順に優先して使うプロバイダーを用意する
     def _init_llm(self):
-        if self.llm_mode == "github":
+        providers = []
+        for mode in self.llm_modes:
+            client, model_name = self.create_llm_client(mode)
+            # 複数のプロバイダーがある場合は同じプロバイダーで再試行せずに次へ切り替える
+            if len(self.llm_modes) > 1:
+                client = client.with_options(max_retries=0)
+            providers.append(Provider(mode, client, model_name, STRUCTURED_OUTPUT_SUPPORT.get(mode)))
+        # 会話履歴のトークン数の計算などには最優先のプロバイダーのモデルを使う
+        self.chat_gpt = providers[0].client
+        self.model_name = providers[0].model_name
+        self.llm_pool = LLMPool(
+            providers,
+            failure_threshold=self.llm_config.get("failure_threshold", 3),
+            cooldown=self.llm_config.get("cooldown_seconds", 30.0),
+            hedge=self.llm_config.get("hedge", False),
+            hedge_percentile=self.llm_config.get("hedge_percentile", 95),
+            hedge_min_delay=self.llm_config.get("hedge_min_delay", 0.3),
+            hedge_initial_delay=self.llm_config.get("hedge_initial_delay", 2.0),
+            metrics=self.metrics,
+        )
+
+    # LLMのクライアントと使用するモデル名を返すメソッド
+    def create_llm_client(self, mode):
+        from openai import OpenAI
+        if mode == "github":
             AZURE_API_KEY = os.environ.get("GITHUB_TOKEN")
-            self.chat_gpt = OpenAI(
+            client = OpenAI(
                 base_url="https://models.inference.ai.azure.com",
                 api_key=AZURE_API_KEY,
             )
-            self.model_name = "gpt-4o-mini"
-        elif self.llm_mode == "groq":
+            return client, "gpt-4o-mini"
+        elif mode == "groq":
             GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
-            self.chat_gpt = OpenAI(
+            client = OpenAI(
                 base_url="https://api.groq.com/openai/v1",
                 api_key=GROQ_API_KEY,
             )
-            self.model_name = "llama-3.3-70b-versatile"
-        elif self.llm_mode == "gemini":
+            return client, "llama-3.3-70b-versatile"
+        elif mode == "gemini":
             GEMINI_API_KEY = os.environ.get("GOOGLE_AI_API_KEY")
-            self.chat_gpt = OpenAI(
+            client = OpenAI(
                 base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
                 api_key=GEMINI_API_KEY,
             )
-            self.model_name = "gemini-1.5-flash"
-        elif self.llm_mode == "azure":
+            return client, "gemini-1.5-flash"
+        elif mode == "azure":
             AZURE_API_KEY = os.environ.get("AZURE_API_KEY")
             AZURE_API_ENDPOINT = os.environ.get("AZURE_API_ENDPOINT")
-            self.chat_gpt = OpenAI(
+            client = OpenAI(
                 base_url=AZURE_API_ENDPOINT,
                 api_key=AZURE_API_KEY,
             )
-            self.model_name = "gpt-4o-mini"
-        elif self.llm_mode == "openai":
+            return client, "gpt-4o-mini"
+        elif mode == "openai":
             OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-            self.chat_gpt = OpenAI(
+            client = OpenAI(
                 api_key=OPENAI_API_KEY,
             )
-            self.model_name = "gpt-4o-mini"
+            return client, "gpt-4o-mini"
+        raise ValueError(f"未対応のLLMです: {mode}")
+
+    # 会話ごとの状態を初期化するメソッド
+    # asyncioランタイムではセッション(サーバー)ごとに呼ばれる
+    def _init_session_state(self):
+        self.chat = self.chat_template.copy()
+        self.websocket = None
+        self.response_id = 0
+        self.generated_audio_dict = {}
+        self.id_of_stopped_audio = None
+        self.next_speaker = None # 次に届く音声を話した人 (ユーザーID, 名前)
+        self.last_sent_response_id = -1 # Botに送信した最後の音声ID
+        # 割り込まれるたびに増える番号。古い番号の処理は破棄される
+        self.turn_generation = 0
+        # 最後の応答の情報(会話履歴のメッセージと、合成した音声ID)
+        self.last_reply = {"generation": 0, "message": None, "audio_ids": []}
+        # 1文も再生されずに会話履歴から削除した最後の応答(取り消しで履歴を戻すときに戻さない)
+        self.dropped_reply = None
+        # 会話履歴(self.chat)と応答の状態を守るロック
+        self.chat_lock = threading.Lock()
+        # 応答の音声を待っているターン(文字起こしが終わった時刻と相づちのタイマー)
+        self.reply_wait = None
+        # 投機的に生成している(まだ確定していない)応答の番号と、次の入力で取り消された応答の番号
+        self.speculative_generation = None
+        self.preempted_generation = None
+        # 話し始めたが、まだ文字起こしの結果が出ていない音声の数
+        self.pending_voices = 0
+        self.speculation_changed = threading.Condition(self.chat_lock)
+        self._init_context()
+
+    def _init_context(self):
+        summarize = self.summarize_history if self.context_config.get("summarize", True) else None
+        self.context = ContextWindow(
+            self.model_name,
+            prefix_length=len(self.chat_template),
+            max_tokens=self.context_config.get("max_tokens", 4000),
+            summarize=summarize,
+        )
 
     def _init_stt(self):
+        from groq import Groq
         self.recognizer_groq = Groq()
+        # 複数人の音声を同時に文字起こしするためのスレッドプール(クライアントは共有する)
+        self.stt_executor = ThreadPoolExecutor(
+            max_workers=max(1, self.runtime_config.get("stt_concurrency", 4)),
+            thread_name_prefix="stt",
+        )
+        # 話した人ごとの文字起こし中の音声(届いた順)と、それを操作するためのロック
+        self.pending_transcripts = {}
+        self.pending_transcripts_lock = threading.Lock()
+        self._init_transcript_processing()
+
+    # 文字起こしの前処理と、結果をふるい分ける設定
+    # 前処理で使うnumpyは前処理が有効な場合のみ読み込む
+    def _init_transcript_processing(self):
+        self.transcript_gate = TranscriptGate(self.stt_config)
+        self.preprocess_voice = None
+        if self.stt_config.get("preprocess", False):
+            from audio_preprocess import preprocess_for_transcription
+            self.preprocess_voice = preprocess_for_transcription
 
     def _init_read_config(self):
+        config = load_config()
+        self.emotion = config["emotion"]["use_emotion"]
+        self.llm_config = config["llm"]
+        self.llm_mode = self.llm_config["mode"]
+        # フェイルオーバーに使うプロバイダー(未指定の場合はmodeのみ)
+        self.llm_modes = self.llm_config.get("modes") or [self.llm_mode]
+        # 感情モードでECoTをJSON形式で出力させるか
+        self.structured_output = self.emotion and self.llm_config.get("structured_output", True)
+        self.stream = config["llm"].get("stream", False)
+        # 最初の入力ですぐに生成を始め、最初の文を音声合成に渡す前に次の入力が届いた場合はまとめて生成し直すか
+        self.speculative = self.llm_config.get("speculative", False)
+        self.tts_config = config.get("tts", {})
+        self.tts_max_concurrency = self.tts_config.get("max_concurrency", 1)
+        self.cache_config = config.get("cache", {})
+        # 音声合成に渡す文の区切り方
+        self.chunking_config = config.get("chunking", {})
+        # 音声の受け渡し方法 (file: ./Tmpと./recordedのファイル, memory: WebSocketのバイナリ)
+        self.audio_transport = config.get("transport", {}).get("audio", "file")
+        # 受け取るメッセージの大きさの上限(バイト)。0の場合は上限なし
+        max_message_mb = config.get("transport", {}).get("max_message_mb", 64)
+        self.max_message_size = int(max_message_mb * 1024 * 1024) if max_message_mb > 0 else None
+        self.stt_config = config.get("stt", {})
+        self.runtime_config = config.get("runtime", {})
+        self.context_config = config.get("context", {})
+        self.metrics_config = config.get("metrics", {})
+        self.startup_config = config.get("startup", {})
+        self.backchannel_config = config.get("backchannel", {})
+
+    # 相づちと、応答までの時間の予測を初期化するメソッド
+    # 相づちの音声は音声合成エンジンの起動後にprepare_backchannelsで合成する
+    def _init_backchannel(self):
+        self.backchannel_bank = BackchannelBank()
+        self.reply_latency = ReplyLatency(initial=self.backchannel_config.get("initial_latency", 2.0))
+
+    # 処理時間の計測を初期化するメソッド
+    # 計測は常に行い、HTTPでの公開はstart時に行う
+    def _init_metrics(self):
+        self.metrics = Metrics(trace_path=self.metrics_config.get("trace_path") or None)
+        self.metrics.register_gauge("emotional_ai_queue_depth", self.queue_depths)
+
+    # キューに溜まっている要素の数を返すメソッド
+    def queue_depths(self):
+        return {(("queue", name),): q.qsize() for name, q in self.queues.items()}
+
+    # メトリクスを公開するHTTPサーバーを起動するメソッド
+    def start_metrics_server(self):
+        if not self.metrics_config.get("enabled", False):
+            return
         try:
-            with open("config.toml", "rb") as f:
-                config = tomllib.load(f)
-            self.emotion = config["emotion"]["use_emotion"]
-            self.llm_mode = config["llm"]["mode"]
-        except UnicodeDecodeError as e:
-            print(f"config.tomlはUTF-8でエンコードされている必要があります。エラー: {e}")
-            raise
-        except FileNotFoundError as e:
-            print(f"config.tomlが見つかりませんでした。エラー: {e}")
-            raise
-        except Exception as e:
-            print(f"config.tomlの読み込み中に予期せぬエラーが発生しました。エラー: {e}")
-            raise
+            self.metrics.start_server(
+                self.metrics_config.get("host", "127.0.0.1"),
+                self.metrics_config.get("port", 9100),
+            )
+        except OSError as e:
+            print(f"メトリクスのHTTPサーバーを起動できませんでした: {e}")
 
     def _init_tmp_folder(self):
-        # Tmpフォルダを作成
-        if not os.path.exists("./Tmp"):
-            os.makedirs("./Tmp")
-        # Tmpフォルダ内のファイルをすべて削除
-        for file in os.listdir("./Tmp"):
-            os.remove(f"./Tmp/{file}")
-        # recordedフォルダを作成
-        if not os.path.exists("./recorded"):
-            os.makedirs("./recorded")
-        # recordedフォルダ内のファイルをすべて削除
-        for file in os.listdir("./recorded"):
-            os.remove(f"./recorded/{file}")
+        # Tmpフォルダとrecordedフォルダを中身(セッションごとのフォルダも含む)ごと削除して作り直す
+        for folder in ("./Tmp", "./recorded"):
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder, exist_ok=True)
 
     def _init_tts(self):
         print("Emotion: ", self.emotion)
-        if self.emotion:
-            self.sound_format = "wav"
-            self.SBV2_URL = "http://127.0.0.1:5000/voice"
-            self.SBV2_HEADERS = {"accept": "audio/wav"}
-            self.tts_params_templete = {
-                "text": "ここに合成したい音声を代入",
-                "speaker_id": 0,
-                "model_id": 2,
-                "length": 1,
-                "sdp_ratio": 0.2,
-                "noise": 0.6,
-                "noisew": 0.8,
-                "auto_split": "true",
-                "split_interval": 1,
-                "language": "JP",
-                "style": "Neutral",
-                "style_weight": 2,
-            }
-        else:
-            self.sound_format = "mp3"
-            self.engine = pyttsx3.init()
+        self.tts_backend = create_backend(self.tts_config, self.emotion)
+        self.tts_backend_name = self.tts_backend.name
+        self.sound_format = self.tts_backend.sound_format
+        print("TTS: ", self.tts_backend_name)
+        # pyttsx3はワーカープロセスの数だけ同時に合成する
+        if self.tts_backend.max_concurrency is not None:
+            self.tts_max_concurrency = self.tts_backend.max_concurrency
+        self._init_audio_encoder()
+        self._init_audio_cache()
+        # 複数の文を同時に合成するためのスレッドプール
+        self.tts_executor = ThreadPoolExecutor(
+            max_workers=max(1, self.tts_max_concurrency),
+            thread_name_prefix="tts",
+        )
+
+
+    # 合成した音声をOgg/Opusに変換する設定
+    def _init_audio_encoder(self):
+        self.audio_encoder = None
+        if self.tts_config.get("encode", "none") != "opus":
+            return
+        encoder = OpusEncoder(
+            ffmpeg=self.tts_config.get("ffmpeg", "ffmpeg"),
+            bitrate_kbps=self.tts_config.get("opus_bitrate_kbps", 64),
+        )
+        if not encoder.available():
+            print("FFmpegが見つからないため、Ogg/Opusへの変換を行わずに送信します")
+            return
+        self.audio_encoder = encoder
+        self.sound_format = encoder.sound_format
+
+    def _init_audio_cache(self):
+        self.audio_cache = None
+        if not self.cache_config.get("enabled", False):
+            return
+        self.audio_cache = AudioCache(
+            self.cache_config.get("directory", "./Cache"),
+            max_bytes=self.cache_config.get("max_size_mb", 200) * 1024 * 1024,
+            persistent=self.cache_config.get("persistent", False),
+        )
+        self.metrics.register_gauge(
+            "emotional_ai_audio_cache",
+            lambda: {(("stat", k),): v for k, v in self.audio_cache.stats().items()},
+        )
+        # 合成結果に影響する設定(合成するテキストは除く)。変換する場合は変換後の形式も含める
+        self.tts_cache_params = self.tts_backend.cache_params()
+        if self.audio_encoder is not None:
+            self.tts_cache_params.update(self.audio_encoder.cache_params())
 
 
     # ヘルパーメソッド群
     # 会話履歴にLLMの返答を追加するメソッド
+    # chat_lockを取得した状態で呼び出す
     def add_llm_response(self, text):
-        self.chat.append(
-            {
-                "role": "assistant",
-                "content": text,
-            }
-        )
+        message = {
+            "role": "assistant",
+            "content": text,
+        }
+        self.chat.append(message)
+        return message
 
     # 会話履歴にユーザーの入力を追加するメソッド
+    # chat_lockを取得した状態で呼び出す
     def add_user_input(self, text):
         self.chat.append(
             {
@@ -244,63 +539,352 @@ class EmotionalAI:
             }
         )
 
-    # StyleBertVITS2サーバーの起動確認
+    # 音声合成エンジンの起動確認
     def check_tts_server(self):
+        return self.tts_backend.check()
+
+    # 最初の応答が遅くならないように、音声合成のモデルの読み込みとLLM、文字起こしへの接続を済ませておくメソッド
+    # 失敗しても起動は続ける
+    def warm_up(self):
+        if not self.startup_config.get("warmup", True):
+            return
+        started = time.monotonic()
+        tasks = {"tts": self.warm_up_tts, "stt": self.recognizer_groq.models.list}
+        for provider in self.llm_pool.providers:
+            tasks[f"llm ({provider.name})"] = provider.client.models.list
+        with ThreadPoolExecutor(max_workers=len(tasks), thread_name_prefix="warmup") as executor:
+            futures = {name: executor.submit(task) for name, task in tasks.items()}
+        for name, future in futures.items():
+            if future.exception() is not None:
+                print(f"{name} のウォームアップに失敗しました: {future.exception()}")
+        print(f"ウォームアップが完了しました ({time.monotonic() - started:.2f}秒)")
+
+    def warm_up_tts(self):
+        text = self.startup_config.get("warmup_text", "こんにちは")
+        if text:
+            self.tts_backend.synthesize(text)
+
+    # 相づちの音声を合成してメモリに置いておくメソッド
+    # 合成が終わるまでは相づちを再生しない
+    def prepare_backchannels(self):
+        if not self.backchannel_config.get("enabled", False):
+            return
+        phrases = self.backchannel_config.get("phrases", DEFAULT_PHRASES)
         try:
-            response = requests.get("http://127.0.0.1:5000/status")
-            return response.status_code == 200
-        except requests.exceptions.ConnectionError:
-            return False
+            for phrase, audio in zip(phrases, self.tts_backend.synthesize_batch(phrases)):
+                if audio is not None:
+                    self.backchannel_bank.add(phrase, self.encode_audio(audio))
         except Exception as e:
-            print(f"予期せぬエラーが発生しました: {e}")
-            return False
+            print(f"相づちの合成に失敗しました: {e}")
+        print(f"相づちを{len(self.backchannel_bank)}個用意しました")
+
+    # 会話履歴をトークン数の上限に収めるメソッド
+    # chat_lockを取得した状態で呼び出す
+    def fit_context(self):
+        self.chat = self.context.fit(self.chat)
+
+    # ユーザーの入力を会話履歴に追加して上限に収めるメソッド
+    # 投機的な応答を取り消したときに戻せるように、追加する前の会話履歴を返す
+    def push_user_input(self, text):
+        with self.chat_lock:
+            history = list(self.chat)
+            self.add_user_input(text)
+            # 上限を超えた古い会話を削除(トークン数節約のため)
+            self.fit_context()
+        return history
+
+    # 投機的な応答を取り消したときに、入力を追加する前の会話履歴に戻すメソッド
+    # その間に再生されなかったとして削除された応答は戻さない
+    def restore_history(self, history):
+        with self.chat_lock:
+            self.chat = [m for m in history if m is not self.dropped_reply]
+
+    # 上限からあふれた会話を要約するメソッド
+    # 要約用のスレッドで実行される
+    def summarize_history(self, previous_summary, messages):
+        conversation = "\n".join(
+            f"{'ユーザー' if m['role'] == 'user' else 'あなた'}: {m['content']}"
+            for m in messages
+        )
+        prompt = f"""
+以下はあなたとユーザーの音声での会話の要約と、その続きの会話です。
+今後の会話で参照できるように、重要な情報(話題、ユーザーの状況や感情、約束したことなど)を残して、全体を日本語で簡潔に要約してください。
+要約のみを出力してください。
+
+# これまでの要約
+{previous_summary or "なし"}
+
+# 続きの会話
+{conversation}
+        """
+        response = self.send_chat_request([{"role": "user", "content": prompt}])
+        if response is None:
+            return None
+        return response.choices[0].message.content
 
     # LLMへリクエストを送信するメソッド
-    def send_chat_request(self, messages):
+    # stream=Trueの場合はチャンクを順に返すストリームを返す
+    # 全てのプロバイダーで失敗した場合はNoneを返す
+    # structured=Trueの場合は対応しているLLMにはECoTのJSON形式で出力させる
+    def send_chat_request(self, messages, stream=False, structured=False):
+        response_format = ECOT_JSON_SCHEMA if structured else None
+        response = self.llm_pool.create(messages, stream=stream, response_format=response_format)
+        if response is None:
+            print("Error sending chat request: 全てのLLMへのリクエストに失敗しました")
+        return response
+
+    # 1文を音声合成のキューに追加するメソッド
+    # 絵文字を削除した文を返す
+    def push_sentence(self, sentence, generation, turn_id):
+        sentence = EMOJI_PATTERN.sub('', sentence)
+        if sentence.strip() and self.commit_reply(generation):
+            self.queues["tts"].put((generation, turn_id, sentence))
+        return sentence
+
+    # 応答の生成中に割り込まれたかを判定するメソッド
+    def is_interrupted(self, generation):
+        return generation != self.turn_generation
+
+    # 新しい応答を始めるメソッド
+    # 割り込みの判定に使う番号を返す
+    def begin_reply(self):
+        with self.chat_lock:
+            generation = self.turn_generation
+            self.last_reply = {"generation": generation, "message": None, "audio_ids": []}
+            if self.speculative:
+                self.speculative_generation = generation
+        return generation
+
+    # 投機的な応答が次の入力で取り消されたかを判定するメソッド
+    def is_preempted(self, generation):
+        return generation == self.preempted_generation
+
+    # 投機的に生成している応答を確定するメソッド
+    # 最初の文を音声合成に渡す前に呼び出し、確定した場合(投機的でない場合を含む)はTrueを返す
+    # 文字起こしの結果を待っている音声がある場合は、結果が出るまでspeculative_max_hold秒を上限に待つ
+    # 待っても結果が出ない(ユーザーが話し続けている)場合は、保留していた割り込みを適用する
+    def commit_reply(self, generation):
+        deadline = time.monotonic() + self.llm_config.get("speculative_max_hold", 3.0)
+        with self.speculation_changed:
+            while True:
+                committed = self.check_commit(generation)
+                if committed is not None:
+                    return committed
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.expire_reply()
+                    break
+                self.speculation_changed.wait(remaining)
+        self.abort_reply()
+        return False
+
+    # 投機的な応答を確定できるかを判定するメソッド
+    # chat_lockを取得した状態で呼び出す
+    # True: 確定した, False: 取り消された, None: 文字起こしの結果を待っている音声があるため待つ
+    def check_commit(self, generation):
+        if self.speculative_generation != generation:
+            return not self.is_interrupted(generation)
+        if not self.queues["user_inputs"].empty():
+            self.preempt_reply()
+            return False
+        if self.pending_voices > 0:
+            return None
+        self.speculative_generation = None
+        self.metrics.increment("emotional_ai_speculative_replies_total", outcome="committed")
+        return True
+
+    # 確定を待っている間にユーザーが話し終わらなかった場合に、保留していた割り込みを適用するメソッド
+    # 話している途中の音声の結果は次の入力として扱う
+    # chat_lockを取得した状態で呼び出し、その後でabort_replyを呼び出す
+    def expire_reply(self):
+        self.speculative_generation = None
+        self.pending_voices = 0
+        self.turn_generation += 1
+        self.metrics.increment("emotional_ai_speculative_replies_total", outcome="interrupted")
+
+    # 確定前の投機的な応答を取り消すメソッド
+    # chat_lockを取得した状態で呼び出す
+    def preempt_reply(self):
+        self.preempted_generation = self.speculative_generation
+        self.speculative_generation = None
+        self.turn_generation += 1
+        self.metrics.increment("emotional_ai_speculative_replies_total", outcome="preempted")
+
+    # 音声の文字起こしが終わったときに呼び出すメソッド
+    # 応答する入力が得られた場合(accepted=True)は、確定前の投機的な応答を取り消して入力をまとめて生成し直させる
+    # 入力をキューに積む前に呼び出す
+    def resolve_voice(self, accepted):
+        with self.chat_lock:
+            self.pending_voices = max(0, self.pending_voices - 1)
+            preempted = accepted and self.speculative_generation is not None
+            if preempted:
+                self.preempt_reply()
+            self.notify_speculation()
+        return preempted
+
+    # 投機的な生成の状態を初期化するメソッド
+    # 会話のリセットや切断の後に、文字起こしの結果が届かなくなった音声を待ち続けないようにする
+    # chat_lockを取得した状態で呼び出す
+    def reset_speculation(self):
+        self.pending_voices = 0
+        self.speculative_generation = None
+        self.preempted_generation = None
+        self.notify_speculation()
+
+    # 投機的な応答の確定を待っている処理に状態の変化を伝えるメソッド
+    # chat_lockを取得した状態で呼び出す
+    def notify_speculation(self):
+        self.speculation_changed.notify_all()
+
+    # LLMの応答の各段階を記録するメソッド
+    def mark_llm(self, turn_id, event):
+        self.metrics.mark(turn_id, event, provider=self.llm_pool.current_provider())
+
+    # 応答を会話履歴に追加するメソッド
+    def finish_reply(self, generation, response_text):
+        # 次の入力で取り消された投機的な応答は履歴に残さない
+        if self.is_preempted(generation):
+            return
+        with self.chat_lock:
+            # 文が1つも無いまま終わった応答も確定したものとする
+            if self.speculative_generation == generation:
+                self.speculative_generation = None
+            if self.last_reply["generation"] == generation:
+                self.last_reply["message"] = self.add_llm_response(response_text)
+        # 生成中に割り込まれた場合は再生される文だけを履歴に残す
+        if self.is_interrupted(generation):
+            self.trim_reply()
+
+    # ユーザーが話し始めたときに応答中の処理を中断するメソッド
+    # 生成中のLLMの応答と、まだ送信していない音声の合成を取り消す
+    # 確定前の投機的な応答はここでは中断せず、話し終わった後の文字起こしの結果でまとめて生成し直すかを決める
+    def interrupt(self):
+        with self.chat_lock:
+            self.pending_voices += 1
+            speculating = self.speculative_generation is not None
+            if not speculating:
+                self.turn_generation += 1
+        self.end_waiting_reply(replied=False)
+        if not speculating:
+            self.abort_reply()
+
+    # 割り込まれた応答の、まだ送信していない音声の合成を取り消して会話履歴を切り詰めるメソッド
+    def abort_reply(self):
+        self.metrics.increment("emotional_ai_interruptions_total")
+        self.drain_queue("tts")
+        for *_, future in self.drain_queue("play"):
+            future.cancel()
+        self.trim_reply()
+
+    # キューに溜まっている要素をすべて取り出すメソッド
+    def drain_queue(self, name):
+        items = []
+        while not self.queues[name].empty():
+            items.append(self.queues[name].get_nowait())
+        return items
+
+    # 最後の応答を実際に再生された文までに切り詰めるメソッド
+    # stopped_idが指定された場合はその音声IDまでが再生されたとみなす
+    def trim_reply(self, stopped_id=None):
+        with self.chat_lock:
+            message = self.last_reply["message"]
+            if message is None:
+                return
+            played_id = self.last_sent_response_id
+            if stopped_id is not None:
+                played_id = min(played_id, stopped_id)
+            played_text = "".join(
+                self.generated_audio_dict[response_id]
+                for response_id in self.last_reply["audio_ids"]
+                if response_id <= played_id
+            ).strip()
+            if played_text and played_text == message["content"]:
+                return
+            if played_text:
+                message["content"] = played_text
+            else:
+                # 1文も再生されなかった場合は応答そのものを履歴から削除
+                self.chat = [m for m in self.chat if m is not message]
+                self.last_reply["message"] = None
+                self.dropped_reply = message
+            print(f"再生された部分までに会話履歴を調整しました: {played_text}")
+
+    # LLMの応答をストリーミングで受け取り、文が完成するたびに音声合成へ渡すメソッド
+    # 感情モードでは「6. 返答」が現れるまでの推論部分を読み飛ばす
+    # 返答部分が見つからなかった場合はNoneを返す
+    def stream_chat_response(self, generation, turn_id):
+        self.mark_llm(turn_id, "llm_request")
+        stream = self.send_chat_request(self.chat, stream=True, structured=self.structured_output)
+        if stream is None:
+            return None
+        reply = ReplyStream(self.emotion, self.chunking_config)
+        response_text = ""
+        received = False  # 最初のトークンを受け取ったか
         try:
-            response = self.chat_gpt.chat.completions.create(
-                messages=messages,
-                model=self.model_name,
-            )
-            return response
+            for chunk in stream:
+                # 割り込まれた場合は接続を閉じて生成を打ち切る
+                if self.is_interrupted(generation):
+                    print("割り込まれたため応答の生成を中断しました")
+                    return response_text.strip()
+                if not chunk.choices:
+                    continue
+                if chunk.choices[0].delta.content and not received:
+                    received = True
+                    self.mark_llm(turn_id, "llm_first_token")
+                for sentence in reply.feed(chunk.choices[0].delta.content):
+                    response_text += self.push_sentence(sentence, generation, turn_id)
+                if reply.finished:
+                    break
         except Exception as e:
-            print(f"Error sending chat request: {e}")
-            return None
+            print(f"ストリーミング中にエラーが発生しました: {e}")
+        finally:
+            stream.close()
+        if not reply.in_reply:
+            # 見出しやキーが見つからなかった場合は応答全体から返答を取り出す
+            sentences = reply.recover()
+            if sentences is None:
+                print("ECoTの結果の抽出中にエラーが発生しました: 返答部分が見つかりませんでした")
+                return None
+            print("フォーマットの崩れた応答から返答を取り出しました")
+            for sentence in sentences:
+                response_text += self.push_sentence(sentence, generation, turn_id)
+        for sentence in reply.flush():
+            response_text += self.push_sentence(sentence, generation, turn_id)
+        self.mark_llm(turn_id, "llm_done")
+        return response_text.strip()
 
-    # 合成された音声ファイルを一時的に保存するメソッド
-    def save_audio(self, audio, sentence):
-        audio_file_path = f"./Tmp/{self.response_id}.{self.sound_format}"
-        self.generated_audio_dict[self.response_id] = sentence
+    # 文に音声IDを割り当てるメソッド
+    # 再生順を保つため、合成を始める前に文の順番どおりに呼び出す
+    # スレッドで動作する場合は相づちと取り合わないように、chat_lockを取得した状態で呼び出す
+    def assign_response_id(self, sentence):
+        response_id = self.response_id
+        self.generated_audio_dict[response_id] = sentence
         self.response_id += 1
-        if self.emotion:
-            with open(audio_file_path, "wb") as f:
-                f.write(audio)
-        else:
-            self.engine.save_to_file(sentence, audio_file_path) # TTSと保存
-            self.engine.runAndWait()
+        return response_id
+
+    # 合成された音声ファイルを一時的に保存するメソッド
+    def save_audio(self, audio, response_id):
+        audio_file_path = f"{self.audio_dir}/{response_id}.{self.sound_format}"
+        with open(audio_file_path, "wb") as f:
+            f.write(audio)
         return audio_file_path
 
     # 音声合成のリクエストを送信するメソッド
     def tts_request(self, text):
         print("以下のテキストを音声合成します: ", text)
-        if self.emotion:
-            try:
-                params = self.tts_params_templete
-                params["text"] = text
-                audio = requests.get(self.SBV2_URL, headers=self.SBV2_HEADERS, params=params).content
-            except Exception as e:
-                print(f"Error generating audio: {e}")
-                return None
-        else:
-            audio = text
-        return audio
+        try:
+            return self.tts_backend.synthesize(text)
+        except Exception as e:
+            print(f"Error generating audio: {e}")
+            return None
 
     # WebSocketサーバーを開始するメソッド
     async def start_websocket_server(self):
         self.websocket_server = await websockets.serve(
             lambda ws: self.websocket_handler(ws),
             "localhost",
-            8765
+            8765,
+            max_size=self.max_message_size
         )
         await self.websocket_server.wait_closed()
 
@@ -315,12 +899,12 @@ class EmotionalAI:
         # WebSocketサーバーを開始
         print("WebSocketサーバーを起動中...")
         self.start_server_thread()
-        # StyleBertVITS2サーバーの起動確認
-        if self.emotion:
-            while not self.check_tts_server():
-                print("TTSサーバーの起動を待機中...")
-                time.sleep(5)
-                continue
+        self.start_metrics_server()
+        # 音声合成エンジンの起動確認
+        wait_until_ready(self.check_tts_server, "TTSサーバー", self.startup_config.get("max_wait_interval", 5.0))
+        # 相づちの合成は起動を遅らせないように裏で行う
+        threading.Thread(target=self.prepare_backchannels, daemon=True).start()
+        self.warm_up()
         # スレッドを設定
         recognize_thread = threading.Thread(target=self.recognize)
         chat_with_llm_thread = threading.Thread(target=self.chat_with_llm)
@@ -333,78 +917,87 @@ class EmotionalAI:
         # メインループ
         print("メインループを起動中...")
         asyncio.run_coroutine_threadsafe(self.send_message("ready"), self.loop)
+        print(f"起動にかかった時間: {time.monotonic() - self.started_at:.2f}秒")
         self.conversation()
 
     # LLMとの会話を処理するメソッド
     # ループで実行される
     def chat_with_llm(self):
+        inputs = []
         while True:
-            user_input = self.queues["user_inputs"].get()
-            self.add_user_input(user_input)
-            # 複数のユーザー入力がある場合はそれらを全て処理
+            inputs.append(self.queues["user_inputs"].get())
+            # 複数のユーザー入力がある場合はそれらを1つの発言にまとめて処理
+            # 計測は最後の入力のターンとして行う
             while not self.queues["user_inputs"].empty():
-                user_input = self.queues["user_inputs"].get()
-                self.add_user_input(user_input)
-            # 過去6回以前の会話を削除(トークン数節約のため)
-            if len(self.chat) > 6:
-                self.chat = self.chat_template + self.chat[-4:]
-            # モデルの応答を生成
-            try:
-                print("Sending to model...")
-                response = self.send_chat_request(self.chat)
-                #response = type('Response', (object,), {'text': "テスト目的で現在はLLMではなく例文を返すようにしています。とりあえず長文であればいいため、このような状態となっています。リアルタイムの会話処理ってすごく難しいんですね。オープンAIの高度な音声モードってどんな仕組みなんでしょうか？"})
-            except Exception as e:
-                print(f"Error generating model response: {e}")
+                inputs.append(self.queues["user_inputs"].get())
+            turn_id = inputs[-1][0]
+            user_input = self.combine_user_inputs(inputs)
+            history = self.push_user_input(user_input)
+            generation = self.begin_reply()
+            self.generate_reply(user_input, generation, turn_id)
+            # 確定前の投機的な応答が次の入力で取り消された場合は、後から届いた入力とまとめて生成し直す
+            if self.is_preempted(generation):
+                print("応答を確定する前に次の入力が届いたため、まとめて生成し直します")
+                self.restore_history(history)
                 continue
-            if self.emotion:
-                try:
-                    response_text = response.choices[0].message.content
-                    if "```" in response_text:
-                        response_text = response_text.split("```")[1].strip()
-                    response_text = response_text.split("6. 返答")[1].strip()
-                except Exception as e:
-                    error_message = str(e)
-                    is_error = True
-                    MAX_RETRY = 5
-                    retry_count = 0
-                    # うまくいくまで繰り返す
-                    while is_error:
-                        if retry_count >= MAX_RETRY:
-                            response_text = "申し訳ございません、エラーが発生しました。"
-                            break
-                        retry_count += 1
-                        print(f"ECoTの結果の抽出中にエラーが発生しました: {error_message}")
-                        # LLMの応答が期待したフォーマットでない場合はプロンプトを調整後、再度送信
-                        rebalanced_user_input = f"""
-                        フォーマットに従って以下のユーザーからの入力に返答してください:
-                        > {user_input}
-                        """
-                        # ユーザー入力を書き換え
-                        self.chat[-1]["content"] = rebalanced_user_input
-                        # ユーザーが処理の間に追加の入力を行った場合はそれをすべて処理
-                        while not self.queues["user_inputs"].empty():
-                            user_input = self.queues["user_inputs"].get()
-                            self.add_user_input(user_input)
-                        # 過去6回以前の会話を削除(トークン数節約のため)
-                        if len(self.chat) > 6:
-                            self.chat = self.chat_template + self.chat[-4:]
-                        try:
-                            response = self.send_chat_request(self.chat)
-                            response_text = response.choices[0].message.content
-                            if "```" in response_text:
-                                response_text = response_text.split("```")[1].strip()
-                            response_text = response_text.split("6. 返答")[1].strip()
-                            is_error = False
-                        except Exception as e:
-                            print(f"再度のECoTの結果の抽出中にエラーが発生しました: {e}")
-                            continue
-            else:
+            inputs = []
+
+    # 1回分の応答を生成するメソッド
+    def generate_reply(self, user_input, generation, turn_id):
+        # ストリーミングモードでは文が完成するたびに音声合成へ渡す
+        if self.stream:
+            print("Streaming from model...")
+            response_text = self.stream_chat_response(generation, turn_id)
+            if response_text is not None:
+                self.finish_reply(generation, response_text)
+                if not self.is_preempted(generation):
+                    print("Model response: ", response_text)
+                return
+            # 返答部分が見つからなかった場合は通常のリクエストでやり直す
+        # モデルの応答を生成
+        print("Sending to model...")
+        response_text = self.request_chat_response(user_input, generation, turn_id)
+        if self.is_interrupted(generation) or not self.commit_reply(generation):
+            print("割り込まれたため応答を破棄しました")
+            self.finish_reply(generation, "")
+            return
+        # 絵文字を削除
+        response_text = EMOJI_PATTERN.sub('', response_text)
+        self.finish_reply(generation, response_text)
+        print("Model response: ", response_text)
+        for chunk in plan_chunks(response_text, self.chunking_config):
+            self.queues["tts"].put((generation, turn_id, chunk))
+
+    # LLMの応答をまとめて受け取るメソッド
+    # 感情モードで返答部分が全く取り出せない場合のみプロンプトを調整して再送信する
+    def request_chat_response(self, user_input, generation, turn_id):
+        MAX_RETRY = 2
+        self.mark_llm(turn_id, "llm_request")
+        for retry_count in range(MAX_RETRY + 1):
+            if retry_count > 0:
+                # LLMの応答が期待したフォーマットでない場合はプロンプトを調整後、再度送信
+                rebalanced_user_input = f"""
+                フォーマットに従って以下のユーザーからの入力に返答してください:
+                > {user_input}
+                """
+                # ユーザー入力を書き換え
+                self.chat[-1]["content"] = rebalanced_user_input
+            response = self.send_chat_request(self.chat, structured=self.structured_output)
+            if self.is_interrupted(generation):
+                return ""
+            if response is None:
+                continue
+            try:
                 response_text = response.choices[0].message.content
-            # 絵文字を削除
-            response_text = re.sub(r'[\U0001F300-\U0001F9FF]', '', response_text)
-            self.add_llm_response(response_text)
-            print("Model response: ", response_text)
-            self.queues["tts"].put(response_text)
+                if self.emotion:
+                    response_text = extract_ecot_reply(response_text)
+                # まとめて受け取る場合は最初のトークンと完了が同時になる
+                self.mark_llm(turn_id, "llm_first_token")
+                self.mark_llm(turn_id, "llm_done")
+                return response_text
+            except Exception as e:
+                print(f"ECoTの結果の抽出中にエラーが発生しました: {e}")
+        return "申し訳ございません、エラーが発生しました。"
 
     # 音声再生を処理し続けるメソッド
     # メインスレッドで実行される
@@ -412,99 +1005,375 @@ class EmotionalAI:
     def conversation(self):
         print("正常に起動しました")
         while True:
-            audio_file_path = self.queues["play"].get()
+            generation, turn_id, response_id, future = self.queues["play"].get()
+            # 割り込まれた応答の音声は送信しない
+            if self.is_interrupted(generation):
+                future.cancel()
+                continue
+            # 合成が終わるまで待つことで、音声ID順に送信する
+            audio = future.result()
+            if audio is None or self.is_interrupted(generation):
+                continue
+            self.end_waiting_reply(replied=True)
+            self.last_sent_response_id = response_id
             try:
-                asyncio.run_coroutine_threadsafe(self.send_message(audio_file_path), self.loop)
+                if isinstance(audio, bytes):
+                    asyncio.run_coroutine_threadsafe(self.send_audio(response_id, audio), self.loop)
+                else:
+                    asyncio.run_coroutine_threadsafe(self.send_message(audio), self.loop)
+                self.metrics.mark(turn_id, "audio_sent", response_id=response_id)
             except Exception as e:
                 print(f"Error sending audio file path: {e}")
 
-    # 音声を処理し一覧に追加するメソッド
+    # 音声を文字起こしのスレッドプールに渡すメソッド
+    # 文字起こしは同時に行い、結果は話した人ごとに届いた順に一覧に追加する
     # ループで実行される
     def recognize(self):
         while True:
-            # 音声入力をテキストに変換
-            audio_file_path = self.queues["user_voice"].get()
-            # 音声が0.5秒未満の場合はスキップ
-            with wave.open(audio_file_path, "rb") as f:
-                frames = f.getnframes()
-                rate = f.getframerate()
-                duration = frames / float(rate)
-            if duration < 0.5:
-                asyncio.run_coroutine_threadsafe(self.send_message("restart"), self.loop)
-                print("Audio too short")
-                os.remove(audio_file_path)
-                continue
-            try:
-                print("Recognizing...")
-                # groqで文字起こし
-                with open(audio_file_path, "rb") as file:
-                    user_input = self.recognizer_groq.audio.transcriptions.create(
-                        file=(audio_file_path, file.read()),
-                        model="whisper-large-v3-turbo",
-                        response_format="text",
-                        language="ja",
-                    )
-                if user_input == "ご視聴ありがとうございました" or user_input == "ありがとうございました" or user_input == "ご視聴ありがとうございました。" or user_input == "ありがとうございました。":
-                    print("文字起こしでハルシネーションが検出されました")
+            turn_id, speaker, voice = self.queues["user_voice"].get()
+            key = speaker[0] if speaker else None
+            future = self.stt_executor.submit(self.transcribe_user_voice, turn_id, voice)
+            with self.pending_transcripts_lock:
+                self.pending_transcripts.setdefault(key, deque()).append((turn_id, speaker, future))
+            future.add_done_callback(lambda _, key=key: self.publish_transcripts(key))
+
+    # 話した人の文字起こしのうち、先頭から終わっているものを順に一覧に追加するメソッド
+    # 前の音声の文字起こしが終わるまで、後の音声の結果は追加しない
+    def publish_transcripts(self, key):
+        with self.pending_transcripts_lock:
+            pending = self.pending_transcripts.get(key)
+            while pending and pending[0][2].done():
+                turn_id, speaker, future = pending.popleft()
+                try:
+                    user_input = future.result()
+                except Exception as e:
+                    # 想定外のエラーでも、文字起こしを待っている応答を確定させてBotに再開を伝える
+                    self.record_rejection(turn_id, "error")
                     asyncio.run_coroutine_threadsafe(self.send_message("restart"), self.loop)
-                    os.remove(audio_file_path)
+                    print(f"文字起こしの処理中にエラーが発生しました: {e}")
+                    user_input = None
+                self.resolve_voice(user_input is not None)
+                if user_input is None:
                     continue
                 print(f"User input: {user_input}")
-                self.queues["user_inputs"].put(user_input)
+                # 相づちの音声IDを応答の音声より先に割り当てるため、入力を渡す前に待ち始める
+                self.begin_waiting_reply(turn_id)
+                self.queues["user_inputs"].put((turn_id, speaker[1] if speaker else None, user_input))
+                asyncio.run_coroutine_threadsafe(self.send_message("delete"), self.loop)
+            if not pending:
+                self.pending_transcripts.pop(key, None)
+
+    # 1つの音声を文字起こしするメソッド
+    # 応答しない場合はBotに再開を伝えてNoneを返す
+    # スレッドプール上で実行される
+    def transcribe_user_voice(self, turn_id, voice):
+        try:
+            audio_data = self.load_user_voice(voice)
+            audio_data, duration = self.prepare_user_voice(audio_data)
+        except Exception as e:
+            self.record_rejection(turn_id, "load_error")
+            asyncio.run_coroutine_threadsafe(self.send_message("restart"), self.loop)
+            print(f"音声データの読み込みに失敗しました: {e}")
+            return None
+        # 声が含まれていない場合は文字起こしを行わない
+        if audio_data is None:
+            self.record_rejection(turn_id, "no_voice")
+            asyncio.run_coroutine_threadsafe(self.send_message("restart"), self.loop)
+            print("No voice detected")
+            return None
+        # 音声が0.5秒未満の場合はスキップ
+        if duration < 0.5:
+            self.record_rejection(turn_id, "too_short")
+            asyncio.run_coroutine_threadsafe(self.send_message("restart"), self.loop)
+            print("Audio too short")
+            return None
+        try:
+            print("Recognizing...")
+            # groqで文字起こし(メモリ上のデータをそのまま送信)
+            # セグメントごとの信頼度も受け取る
+            transcription = self.recognizer_groq.audio.transcriptions.create(
+                file=("voice.wav", audio_data),
+                model="whisper-large-v3-turbo",
+                response_format="verbose_json",
+                language="ja",
+            )
+        except Exception as e:
+            self.record_rejection(turn_id, "stt_error")
+            asyncio.run_coroutine_threadsafe(self.send_message("restart"), self.loop)
+            print("文字起こし中にエラーが発生しました: ", e)
+            return None
+        self.metrics.mark(turn_id, "stt_done", duration=duration)
+        user_input = self.check_transcript(turn_id, transcription)
+        if user_input is None:
+            asyncio.run_coroutine_threadsafe(self.send_message("restart"), self.loop)
+        return user_input
+
+    # キューから取り出したユーザー入力 (ターンID, 話した人の名前, 発言) を1つの発言にまとめるメソッド
+    # 同じ人が続けて話した発言は1行にまとめ、名前が分かる場合は「名前: 発言」の形にする
+    def combine_user_inputs(self, inputs):
+        lines = []
+        for _, speaker, text in inputs:
+            if lines and lines[-1][0] == speaker:
+                lines[-1][1] += " " + text
+            else:
+                lines.append([speaker, text])
+        tag = self.stt_config.get("tag_speaker", True)
+        return "\n".join(f"{speaker}: {text}" if tag and speaker else text for speaker, text in lines)
+
+    # 応答せずに捨てた発話を記録するメソッド
+    def record_rejection(self, turn_id, reason):
+        self.metrics.mark(turn_id, "rejected", reason=reason)
+        self.metrics.increment("emotional_ai_rejected_utterances_total", reason=reason)
+
+    # 文字起こしの結果をLLMに渡してよいかを判定するメソッド
+    # 定型文や信頼度の低い文字起こしの場合は記録してNoneを返す
+    def check_transcript(self, turn_id, transcription):
+        user_input, reason = self.transcript_gate.check(transcription)
+        if reason is not None:
+            self.record_rejection(turn_id, reason)
+            print(f"文字起こしの結果を破棄しました ({reason}): {user_input}")
+            return None
+        return user_input
+
+    # Botから受け取った音声をWAV形式のバイト列として読み込むメソッド
+    # ファイルのパスの場合は読み込んだ後にファイルを削除する
+    def load_user_voice(self, voice):
+        if isinstance(voice, str):
+            try:
+                with open(voice, "rb") as f:
+                    return f.read()
+            finally:
+                os.remove(voice)
+        # ヘッダーの無いPCMデータの場合はWAV形式に変換
+        if not voice.startswith(b"RIFF"):
+            return pcm_to_wav(voice)
+        return voice
+
+    # 文字起こしに送る音声を用意するメソッド
+    # 設定が有効ならモノラル16kHzに変換し、前後の無音を取り除く
+    # (WAV形式のバイト列, 秒数)を返す。声が含まれていない場合は(None, 0.0)を返す
+    def prepare_user_voice(self, audio_data):
+        if self.preprocess_voice is not None:
+            try:
+                return self.preprocess_voice(
+                    audio_data,
+                    threshold_db=self.stt_config.get("vad_threshold_db", -45.0),
+                    margin_ms=self.stt_config.get("vad_margin_ms", 200),
+                )
             except Exception as e:
-                asyncio.run_coroutine_threadsafe(self.send_message("restart"), self.loop)
-                print("文字起こし中にエラーが発生しました: ", e)
-                os.remove(audio_file_path)
-                continue
-            os.remove(audio_file_path)
-            asyncio.run_coroutine_threadsafe(self.send_message("delete"), self.loop)
-            self.stop_flag.set()
+                print(f"音声の前処理に失敗したため、そのまま文字起こしします: {e}")
+        with wave.open(io.BytesIO(audio_data), "rb") as f:
+            duration = f.getnframes() / float(f.getframerate())
+        return audio_data, duration
 
     # 音声を合成するメソッド
     # ループで実行される
     def text_to_speech(self):
         while True:
-            text = self.queues["tts"].get()
-            sentences = re.split(r'([。．.!?！？;:]|\n)', text)  # カッコで囲むことで区切り文字を保持
-            sentences = [''.join(i) for i in zip(sentences[::2], sentences[1::2] + [''])]  # 区切り文字と結合
-            for sentence in sentences:
-                if sentence.strip() and re.search(r'[a-zA-Z0-9\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FFF]', sentence): # 文字が含まれているか
-                    audio = self.tts_request(sentence)
-                    audio_file_path = self.save_audio(audio, sentence)
-                    self.queues["play"].put(audio_file_path)
+            generation, turn_id, sentence = self.queues["tts"].get()
+            # 割り込まれた応答の文は合成しない
+            if self.is_interrupted(generation):
+                continue
+            # 文の区切り方はキューに積む前に決めてあるため、そのまま合成する
+            if sentence.strip() and SPEAKABLE_PATTERN.search(sentence): # 文字が含まれているか
+                with self.chat_lock:
+                    response_id = self.assign_response_id(sentence)
+                    if self.last_reply["generation"] == generation:
+                        self.last_reply["audio_ids"].append(response_id)
+                # 合成はスレッドプールで並列に行い、再生キューには順番どおりにFutureを積む
+                future = self.tts_executor.submit(self.synthesize, sentence, response_id, turn_id)
+                self.queues["play"].put((generation, turn_id, response_id, future))
+
+    # 1文を音声合成するメソッド
+    # fileモードでは保存したファイルのパスを、memoryモードでは音声のバイト列を返す
+    # スレッドプール上で実行される
+    def synthesize(self, sentence, response_id, turn_id=None):
+        started = time.monotonic()
+        try:
+            cache_key, cached = self.lookup_cached_audio(sentence, response_id)
+            if cached is not None:
+                self.record_synthesis(turn_id, response_id, started, cached=True)
+                return cached
+            audio = self.tts_request(sentence)
+            if audio is None:
+                return None
+            audio = self.deliver_audio(audio, response_id, cache_key)
+            self.record_synthesis(turn_id, response_id, started, cached=False)
+            return audio
+        except Exception as e:
+            print(f"音声ID {response_id} の合成中にエラーが発生しました: {e}")
+            return None
+
+    # 1文の合成にかかった時間を記録するメソッド
+    def record_synthesis(self, turn_id, response_id, started, cached):
+        elapsed = time.monotonic() - started
+        if not cached:
+            self.metrics.observe("tts", elapsed, provider=self.tts_backend_name)
+        self.metrics.mark(turn_id, "sentence_synthesized", response_id=response_id, cached=cached, seconds=elapsed)
+
+    # キャッシュから合成済みの音声を探すメソッド
+    # (キャッシュのキー, 見つかった場合はsynthesizeと同じ形式の結果)を返す
+    def lookup_cached_audio(self, sentence, response_id):
+        if self.audio_cache is None:
+            return None, None
+        cache_key = self.audio_cache.make_key(sentence, self.tts_backend_name, self.tts_cache_params)
+        # キャッシュにあれば音声合成を行わずにそのまま再生する
+        if self.audio_transport == "memory":
+            cached = self.audio_cache.get(cache_key)
+        else:
+            audio_file_path = f"{self.audio_dir}/{response_id}.{self.sound_format}"
+            cached = audio_file_path if self.audio_cache.copy_to(cache_key, audio_file_path) else None
+        if cached is not None:
+            print(f"キャッシュされた音声を使用します: {sentence} {self.audio_cache.stats()}")
+        return cache_key, cached
+
+    # 合成した音声を再生できる形にしてキャッシュに追加するメソッド
+    # 変換が有効な場合はOgg/Opusに変換してからキャッシュと送信に使う
+    # fileモードでは保存したファイルのパスを、memoryモードでは音声のバイト列を返す
+    def deliver_audio(self, audio, response_id, cache_key=None):
+        audio = self.encode_audio(audio)
+        if cache_key is not None:
+            self.audio_cache.put(cache_key, audio)
+        if self.audio_transport == "memory":
+            return audio
+        return self.save_audio(audio, response_id)
+
+    # 変換が有効な場合は音声をOgg/Opusに変換するメソッド
+    def encode_audio(self, audio):
+        if self.audio_encoder is None:
+            return audio
+        started = time.monotonic()
+        audio = self.audio_encoder.encode(audio)
+        self.metrics.observe("encode", time.monotonic() - started)
+        return audio
+
+    # 文字起こしが終わり、応答の音声を待ち始めるメソッド
+    # 応答までの時間の予測が閾値を超える場合は、少し待っても応答の音声が送られなければ相づちを再生する
+    # 相づちの音声IDは応答の音声より前の番号になるように、ここで先に割り当てておく
+    def begin_waiting_reply(self, turn_id):
+        predicted = self.reply_latency.predict()
+        clip = None
+        if predicted >= self.backchannel_config.get("min_predicted_latency", 1.5):
+            clip = self.backchannel_bank.choose()
+        # pending: 相づちをまだ再生しておらず、再生する予定がある
+        wait = {"turn_id": turn_id, "started": time.monotonic(), "pending": clip is not None, "timer": None, "clip": clip}
+        # 前の発話の応答を待っている場合は、その相づちを取り消して待ち直す
+        self.end_waiting_reply(replied=False)
+        with self.chat_lock:
+            if clip is not None:
+                wait["response_id"] = self.assign_response_id(clip[0])
+            self.reply_wait = wait
+        if wait["pending"]:
+            wait["timer"] = self.start_backchannel_timer(self.backchannel_config.get("grace_seconds", 0.3), wait)
+
+    # 応答の音声を送る直前(replied=True)か割り込まれたときに呼び出し、相づちを取り消すメソッド
+    # 応答の音声を送る場合は、文字起こしから応答までの時間を次の予測のために記録する
+    def end_waiting_reply(self, replied):
+        with self.chat_lock:
+            wait, self.reply_wait = self.reply_wait, None
+        if wait is None:
+            return
+        if wait["pending"]:
+            if wait["timer"] is not None:
+                wait["timer"].cancel()
+            self.metrics.increment("emotional_ai_backchannels_total", outcome="suppressed")
+        if replied:
+            self.reply_latency.observe(time.monotonic() - wait["started"])
+
+    # delay秒後に相づちを再生するタイマーを開始するメソッド
+    def start_backchannel_timer(self, delay, wait):
+        timer = threading.Timer(delay, self.play_backchannel, args=(wait,))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    # タイマーから呼び出され、応答の音声がまだ送られていなければ相づちを送信するメソッド
+    # 応答の音声と送信の順番が入れ替わらないように、chat_lockを取得したまま送信を依頼する
+    def play_backchannel(self, wait):
+        with self.chat_lock:
+            backchannel = self.take_backchannel(wait)
+            if backchannel is not None:
+                asyncio.run_coroutine_threadsafe(self.send_backchannel(*backchannel), self.loop)
+
+    # 待ち始めたときに選んだ相づちを再生するか決めるメソッド
+    # chat_lockを取得した状態で呼び出す
+    # (音声ID, fileモードでは保存したファイルのパス、memoryモードではバイト列)を返す。再生しない場合はNoneを返す
+    def take_backchannel(self, wait):
+        if self.reply_wait is not wait or not wait["pending"]:
+            return None
+        wait["pending"] = False
+        phrase, audio = wait["clip"]
+        response_id = wait["response_id"]
+        if self.audio_transport != "memory":
+            audio = self.save_audio(audio, response_id)
+        self.metrics.increment("emotional_ai_backchannels_total", outcome="played")
+        self.metrics.mark(wait["turn_id"], "backchannel_sent", response_id=response_id, phrase=phrase)
+        print(f"相づちを再生します: {phrase}")
+        return response_id, audio
+
+    # 相づちの音声を送信するメソッド
+    async def send_backchannel(self, response_id, audio):
+        if isinstance(audio, bytes):
+            await self.send_audio(response_id, audio)
+        else:
+            await self.send_message(audio)
 
     # WebSocketハンドラー
     async def websocket_handler(self, websocket):
         try:
             self.websocket = websocket
             async for message in websocket:
-                if message == "speech_start":
-                    print("Discord: Speech started")
-                    self.stop_flag.set()  # 現在の音声を停止
-                elif message == "speech_end":
-                    print("Discord: Speech ended")
-                elif message.endswith(".wav"):
-                    try:
-                        # 音声データを受信
-                        audio_file_path = message
-                        if audio_file_path is not None:
-                            self.queues["user_voice"].put(audio_file_path)
-                        else:
-                            print("受け取った音声データのパスがNoneです")
-                    except Exception as e:
-                        print(f"音声ファイルパスの受け取りに失敗しました: {e}")
-                elif message.isdigit():
-                    self.id_of_stopped_audio = int(message)
-                    print(f"音声ID {self.id_of_stopped_audio} まで再生されたところで再生が停止されました")
-                elif message == "exit":
-                    self.chat = self.chat_template
-                    print("会話をリセットしました")
-                else:
-                    print(f"受信したメッセージ: {message}")
+                await self.handle_message(message)
         except websockets.exceptions.ConnectionClosed:
             pass
         finally:
             self.websocket = None
+            with self.chat_lock:
+                self.reset_speculation()
+
+    # Botから受け取ったメッセージを処理するメソッド
+    async def handle_message(self, message):
+        # バイナリフレームは録音された音声データ(WAVまたはPCM)
+        if isinstance(message, bytes):
+            await self.enqueue_user_voice(message)
+        elif message == "speech_start":
+            print("Discord: Speech started")
+            self.interrupt()  # 応答中の処理を中断
+        elif message == "speech_end":
+            print("Discord: Speech ended")
+        elif message.startswith("speaker:"):
+            # 次に届く音声を話した人 (speaker:<ユーザーID>:<名前>)
+            user_id, _, name = message[len("speaker:"):].partition(":")
+            self.next_speaker = (user_id, name.strip() or user_id)
+        elif message.endswith(".wav"):
+            try:
+                # 音声データを受信
+                audio_file_path = message
+                if audio_file_path is not None:
+                    await self.enqueue_user_voice(audio_file_path)
+                else:
+                    print("受け取った音声データのパスがNoneです")
+            except Exception as e:
+                print(f"音声ファイルパスの受け取りに失敗しました: {e}")
+        elif message.isdigit():
+            self.id_of_stopped_audio = int(message)
+            print(f"音声ID {self.id_of_stopped_audio} まで再生されたところで再生が停止されました")
+            self.trim_reply(self.id_of_stopped_audio)
+        elif message == "exit":
+            with self.chat_lock:
+                self.chat = self.chat_template.copy()
+                self.reset_speculation()
+            self.context.reset()
+            print("会話をリセットしました")
+        else:
+            print(f"受信したメッセージ: {message}")
+
+    # 受け取った音声を文字起こしのキューに追加するメソッド
+    # 処理時間の計測はここから始まる
+    async def enqueue_user_voice(self, voice):
+        turn_id = self.metrics.start_turn(self.session_id)
+        speaker, self.next_speaker = self.next_speaker, None
+        self.queues["user_voice"].put((turn_id, speaker, voice))
 
     # websocketでメッセージを送信するメソッド
     async def send_message(self, message):
@@ -515,7 +1384,24 @@ class EmotionalAI:
             except Exception as e:
                 print(f"メッセージの送信に失敗しました: {e}")
 
+    # websocketで合成した音声をバイナリで送信するメソッド
+    # 先頭に音声ID(4バイト)、形式名の長さ(1バイト)、形式名を付ける
+    async def send_audio(self, response_id, audio):
+        if hasattr(self, "websocket") and self.websocket:
+            sound_format = self.sound_format.encode("ascii")
+            header = struct.pack(">IB", response_id, len(sound_format)) + sound_format
+            try:
+                await self.websocket.send(header + audio)
+                print(f"音声ID {response_id} ({len(audio)}バイト) を送信しました")
+            except Exception as e:
+                print(f"音声の送信に失敗しました: {e}")
+
 
 if __name__ == "__main__":
-    emotional_ai = EmotionalAI()
-    emotional_ai.start()
\ No newline at end of file
+    # config.tomlの[runtime]でasyncioが指定されている場合はイベントループ1つで動作するランタイムを使う
+    if load_config().get("runtime", {}).get("mode", "thread") == "asyncio":
+        from async_runtime import AsyncEmotionalAI
+        emotional_ai = AsyncEmotionalAI()
+    else:
+        emotional_ai = EmotionalAI()
+    emotional_ai.start()
@@ -0,0 +1,168 @@
+# 1回の発話(ターン)ごとの処理時間の計測
+# 各段階の時刻を単調増加の時計で記録し、遅延のヒストグラムとキューの長さを
+# Prometheus形式のHTTPエンドポイントで公開する。JSONL形式のトレースログも出力できる
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ヒストグラムの区切り(秒)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 20.0)
+# (開始のイベント, 終了のイベント)の間の時間を段階ごとの遅延として記録する
+STAGES = {
+    "stt": ("audio_received", "stt_done"),
+    "llm_first_token": ("llm_request", "llm_first_token"),
+    "llm_total": ("llm_request", "llm_done"),
+    "time_to_first_audio": ("audio_received", "audio_sent"),
+    "time_to_backchannel": ("audio_received", "backchannel_sent"),
+}
+# 保持しておくターンの数
+MAX_TURNS = 256
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+
+    def __init__(self, trace_path=None):
+        self.lock = threading.Lock()
+        self.turn_ids = itertools.count(1)
+        self.turns = OrderedDict()  # ターンID -> {イベント名: 時刻}
+        self.histograms = {}  # (名前, ラベル) -> Histogram
+        self.counters = {}  # (名前, ラベル) -> 値
+        self.gauges = {}  # 名前 -> {ラベル: 値}の辞書を返す関数
+        self.trace_file = open(trace_path, "a", encoding="utf-8") if trace_path else None
+        self.server = None
+
+    # 新しいターンを開始し、ターンIDを返す
+    def start_turn(self, session=None):
+        turn_id = next(self.turn_ids)
+        with self.lock:
+            self.turns[turn_id] = {"session": session}
+            while len(self.turns) > MAX_TURNS:
+                self.turns.popitem(last=False)
+        self.mark(turn_id, "audio_received")
+        return turn_id
+
+    # ターンのイベントを記録する
+    def mark(self, turn_id, event, **fields):
+        now = time.monotonic()
+        with self.lock:
+            turn = self.turns.get(turn_id)
+            if turn is None:
+                return
+            # 応答したLLMのプロバイダーを覚えておき、以降の段階のラベルにも使う
+            if fields.get("provider"):
+                turn["provider"] = fields["provider"]
+            if event not in turn:
+                turn[event] = now
+                for stage, (start_event, end_event) in STAGES.items():
+                    if end_event == event and start_event in turn:
+                        self._observe(stage, now - turn[start_event], turn.get("provider"))
+            start = turn.get("audio_received", now)
+            session = turn["session"]
+        self._trace({
+            "turn": turn_id,
+            "session": session,
+            "event": event,
+            "t": now,
+            "elapsed": now - start,
+            **fields,
+        })
+
+    # 処理時間を直接記録する
+    def observe(self, stage, seconds, provider=None):
+        with self.lock:
+            self._observe(stage, seconds, provider)
+
+    def _observe(self, stage, seconds, provider=None):
+        labels = (("stage", stage),) if provider is None else (("stage", stage), ("provider", provider))
+        histogram = self.histograms.setdefault(("emotional_ai_latency_seconds", labels), Histogram())
+        histogram.observe(seconds)
+
+    # カウンターを増やす
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    # 取得時に値を計算するゲージを登録する
+    def register_gauge(self, name, collect):
+        self.gauges[name] = collect
+
+    def _trace(self, record):
+        if self.trace_file is None:
+            return
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            self.trace_file.write(line + "\n")
+            self.trace_file.flush()
+
+    # Prometheusのテキスト形式で出力する
+    def render(self):
+        lines = []
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                # countsはobserve時点で累積済み
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{_labels(labels)} {value}")
+        for name, collect in sorted(self.gauges.items()):
+            try:
+                values = collect()
+            except Exception as e:
+                print(f"メトリクス {name} の取得に失敗しました: {e}")
+                continue
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    # メトリクスを公開するHTTPサーバーを別スレッドで起動する
+    def start_server(self, host, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"メトリクスを http://{host}:{self.server.server_port}/metrics で公開しています")
+
+
+# ラベルをPrometheusの形式にする関数
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
@@ -0,0 +1,32 @@
+# 起動時に外部サービスの準備ができるまで待つ処理
+# 一定間隔で確認すると起動済みでも最大でその間隔だけ待たされるため、
+# 短い間隔から始めて倍々に延ばしながら確認する
+import asyncio
+import time
+
+# 最初の確認の間隔(秒)
+INITIAL_INTERVAL = 0.1
+
+
+# checkがTrueを返すまで待つ関数
+def wait_until_ready(check, name, max_interval=5.0):
+    interval = INITIAL_INTERVAL
+    started = time.monotonic()
+    while not check():
+        if interval == INITIAL_INTERVAL:
+            print(f"{name}の起動を待機中...")
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+    return time.monotonic() - started
+
+
+# asyncio版
+async def await_until_ready(check, name, max_interval=5.0):
+    interval = INITIAL_INTERVAL
+    started = time.monotonic()
+    while not await check():
+        if interval == INITIAL_INTERVAL:
+            print(f"{name}の起動を待機中...")
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, max_interval)
+    return time.monotonic() - started
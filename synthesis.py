@@ -1,54 +1,343 @@
-import requests
-import json
-import tempfile
-import winsound
+# 音声合成エンジンを切り替えて使うためのクラス群
+# config.tomlの[tts] backendで使用するエンジンを選択する
+# HTTPのエンジンは接続を使い回すため、エンジンごとにセッション(コネクションプール)を1つ持つ
+# 各エンジンが使うライブラリは、そのエンジンを使う場合のみ読み込む
+import asyncio
 import os
+import threading
+from collections import OrderedDict
 
-engine_api = "http://127.0.0.1:50032"
-
-# 音声を合成する関数
-def tts(text, speaker, engine):
-    if engine == "voicevox":
-        return voicevox(text, speaker)
-    if engine == "coeiroink":
-        speaker = "3c37646f-3881-5374-2a83-149267990abc"
-        styleId = 0
-        response = coeiroink(styleId, speaker, text)
-        return response
-
-def voicevox(text, speaker):
-    # 音声合成用のクエリ作成
-    query = requests.post(
-        f'http://127.0.0.1:50021/audio_query',
-        params=(('text', text),('speaker', speaker),)
-    )
-    # 音声合成
-    synthesis = requests.post(
-        f'http://127.0.0.1:50021/synthesis',
-        headers = {"Content-Type": "application/json"},
-        params=(('text', text),('speaker', speaker),),
-        data = json.dumps(query.json())
+
+class TTSBackend:
+
+    name = ""
+    sound_format = "wav"
+    # 同時に合成できる数(Noneの場合は[tts] max_concurrencyに従う)
+    max_concurrency = None
+
+    def synthesize(self, text):
+        raise NotImplementedError
+
+    async def asynthesize(self, text):
+        return await asyncio.to_thread(self.synthesize, text)
+
+    # 複数の文を合成し、渡した順に音声データを返す(失敗した文はNone)
+    def synthesize_batch(self, texts):
+        results = []
+        for text in texts:
+            try:
+                results.append(self.synthesize(text))
+            except Exception as e:
+                print(f"音声合成に失敗しました: {text} ({e})")
+                results.append(None)
+        return results
+
+    # エンジンが使える状態かを確認する
+    def check(self):
+        return True
+
+    async def acheck(self):
+        return self.check()
+
+    # キャッシュのキーに含める、合成結果に影響する設定
+    def cache_params(self):
+        return {}
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        self.close()
+
+
+# HTTPで合成するエンジンの共通部分
+class HTTPBackend(TTSBackend):
+
+    # (接続, 読み込み)のタイムアウト(秒)
+    DEFAULT_TIMEOUT = (3.0, 30.0)
+    DEFAULT_URL = ""
+    STATUS_PATH = "/"
+
+    def __init__(self, config, concurrency=1):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.url = config.get("url", self.DEFAULT_URL).rstrip("/")
+        self.timeout = (
+            config.get("connect_timeout", self.DEFAULT_TIMEOUT[0]),
+            config.get("read_timeout", self.DEFAULT_TIMEOUT[1]),
+        )
+        self.concurrency = max(1, concurrency)
+        # 同時に合成する数だけ接続を保持しておく
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.async_client = None
+
+    # asyncioのクライアントはイベントループの中で初めて使うときに作成する
+    def _async_client(self):
+        if self.async_client is None:
+            import httpx
+            self.async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                limits=httpx.Limits(
+                    max_connections=self.concurrency,
+                    max_keepalive_connections=self.concurrency,
+                ),
+            )
+        return self.async_client
+
+    def check(self):
+        import requests
+        try:
+            response = self.session.get(self.url + self.STATUS_PATH, timeout=self.timeout)
+            return response.status_code == 200
+        except requests.exceptions.ConnectionError:
+            return False
+        except Exception as e:
+            print(f"予期せぬエラーが発生しました: {e}")
+            return False
+
+    async def acheck(self):
+        import httpx
+        try:
+            response = await self._async_client().get(self.url + self.STATUS_PATH)
+            return response.status_code == 200
+        except httpx.TransportError:
+            return False
+        except Exception as e:
+            print(f"予期せぬエラーが発生しました: {e}")
+            return False
+
+    def close(self):
+        self.session.close()
+
+    async def aclose(self):
+        self.close()
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
+
+
+class StyleBertVITS2Backend(HTTPBackend):
+
+    name = "sbv2"
+    DEFAULT_URL = "http://127.0.0.1:5000"
+    STATUS_PATH = "/status"
+    HEADERS = {"accept": "audio/wav"}
+
+    def __init__(self, config, concurrency=1):
+        super().__init__(config, concurrency)
+        self.params_template = {
+            "text": "ここに合成したい音声を代入",
+            "speaker_id": 0,
+            "model_id": 2,
+            "length": 1,
+            "sdp_ratio": 0.2,
+            "noise": 0.6,
+            "noisew": 0.8,
+            "auto_split": "true" if config.get("auto_split", True) else "false",
+            "split_interval": 1,
+            "language": "JP",
+            "style": "Neutral",
+            "style_weight": 2,
+        }
+
+    def _params(self, text):
+        # 複数スレッドから同時に呼ばれるためテンプレートはコピーして使う
+        params = dict(self.params_template)
+        params["text"] = text
+        # auto_splitは改行で区切って合成するため、改行を含まない文では使わない
+        if "\n" not in text:
+            params["auto_split"] = "false"
+        return params
+
+    def synthesize(self, text):
+        response = self.session.get(
+            self.url + "/voice",
+            headers=self.HEADERS,
+            params=self._params(text),
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.content
+
+    async def asynthesize(self, text):
+        response = await self._async_client().get(
+            self.url + "/voice",
+            headers=self.HEADERS,
+            params=self._params(text),
+        )
+        response.raise_for_status()
+        return response.content
+
+    def cache_params(self):
+        return {k: v for k, v in self.params_template.items() if k != "text"}
+
+
+class VoicevoxBackend(HTTPBackend):
+
+    name = "voicevox"
+    DEFAULT_URL = "http://127.0.0.1:50021"
+    STATUS_PATH = "/version"
+    # 保持しておくaudio_queryの結果の数
+    QUERY_CACHE_SIZE = 256
+
+    def __init__(self, config, concurrency=1):
+        super().__init__(config, concurrency)
+        self.speaker = config.get("speaker", 1)
+        # 同じ文のaudio_queryを繰り返さないように結果を保持する(古いものが先頭)
+        self.query_cache = OrderedDict()
+        self.query_lock = threading.Lock()
+
+    def _cached_query(self, text):
+        with self.query_lock:
+            query = self.query_cache.get(text)
+            if query is not None:
+                self.query_cache.move_to_end(text)
+            return query
+
+    def _store_query(self, text, query):
+        with self.query_lock:
+            self.query_cache[text] = query
+            self.query_cache.move_to_end(text)
+            while len(self.query_cache) > self.QUERY_CACHE_SIZE:
+                self.query_cache.popitem(last=False)
+
+    def synthesize(self, text):
+        # 音声合成用のクエリ作成
+        query = self._cached_query(text)
+        if query is None:
+            response = self.session.post(
+                self.url + "/audio_query",
+                params={"text": text, "speaker": self.speaker},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            query = response.content
+            self._store_query(text, query)
+        # 音声合成
+        response = self.session.post(
+            self.url + "/synthesis",
+            headers={"Content-Type": "application/json"},
+            params={"speaker": self.speaker},
+            data=query,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.content
+
+    async def asynthesize(self, text):
+        client = self._async_client()
+        query = self._cached_query(text)
+        if query is None:
+            response = await client.post(
+                self.url + "/audio_query",
+                params={"text": text, "speaker": self.speaker},
+            )
+            response.raise_for_status()
+            query = response.content
+            self._store_query(text, query)
+        response = await client.post(
+            self.url + "/synthesis",
+            headers={"Content-Type": "application/json"},
+            params={"speaker": self.speaker},
+            content=query,
+        )
+        response.raise_for_status()
+        return response.content
+
+    def cache_params(self):
+        return {"speaker": self.speaker}
+
+
+class CoeiroinkBackend(HTTPBackend):
+
+    name = "coeiroink"
+    DEFAULT_URL = "http://127.0.0.1:50032"
+    STATUS_PATH = "/v1/speakers"
+
+    def __init__(self, config, concurrency=1):
+        super().__init__(config, concurrency)
+        self.speaker_uuid = config.get("speaker_uuid", "3c37646f-3881-5374-2a83-149267990abc")
+        self.style_id = config.get("style_id", 0)
+        self.speed_scale = config.get("speed_scale", 1)
+
+    def _payload(self, text):
+        return {
+            "text": text,
+            "speakerUuid": self.speaker_uuid,
+            "styleId": self.style_id,
+            "prosodyDetail": None,
+            "speedScale": self.speed_scale,
+        }
+
+    def synthesize(self, text):
+        response = self.session.post(self.url + "/v1/predict", json=self._payload(text), timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    async def asynthesize(self, text):
+        response = await self._async_client().post(self.url + "/v1/predict", json=self._payload(text))
+        response.raise_for_status()
+        return response.content
+
+    def cache_params(self):
+        return {"speaker_uuid": self.speaker_uuid, "style_id": self.style_id, "speed_scale": self.speed_scale}
+
+
+class Pyttsx3Backend(TTSBackend):
+
+    name = "pyttsx3"
+    sound_format = "mp3"
+    # 1文の合成を待つ時間(秒)。これを過ぎたワーカーは再起動する
+    DEFAULT_TIMEOUT = 30.0
+    # エンジンに設定できる値
+    PROPERTIES = ("rate", "volume", "voice")
+
+    def __init__(self, config, concurrency=1):
+        from tts_worker_pool import Pyttsx3WorkerPool
+        # pyttsx3のエンジンは1つずつしか合成できないため、ワーカープロセスの数だけ同時に合成する
+        workers = config.get("workers") or os.cpu_count() or 1
+        self.max_concurrency = workers
+        self.pool = Pyttsx3WorkerPool(
+            workers,
+            timeout=config.get("timeout", self.DEFAULT_TIMEOUT),
+            properties={key: config[key] for key in self.PROPERTIES if key in config},
+            suffix=f".{self.sound_format}",
+        )
+
+    def synthesize(self, text):
+        return self.pool.synthesize(text)
+
+    async def asynthesize(self, text):
+        return await asyncio.get_running_loop().run_in_executor(self.pool.executor, self.pool.synthesize, text)
+
+    def synthesize_batch(self, texts):
+        return self.pool.synthesize_batch(texts)
+
+    def cache_params(self):
+        return dict(self.pool.engine_properties)
+
+    def close(self):
+        self.pool.close()
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (StyleBertVITS2Backend, VoicevoxBackend, CoeiroinkBackend, Pyttsx3Backend)
+}
+
+
+# config.tomlの[tts]の設定から音声合成エンジンを作成する関数
+# backend = "auto"の場合は感情モードならStyleBertVITS2、それ以外はpyttsx3を使う
+def create_backend(tts_config, emotion):
+    name = tts_config.get("backend", "auto")
+    if name == "auto":
+        name = "sbv2" if emotion else "pyttsx3"
+    if name not in BACKENDS:
+        raise ValueError(f"未対応の音声合成エンジンです: {name} (使用可能: {', '.join(BACKENDS)})")
+    return BACKENDS[name](
+        tts_config.get(name, {}),
+        concurrency=tts_config.get("max_concurrency", 1),
     )
-    # 一時ファイルを作成し、音声データを保存
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_file:
-        temp_file.write(synthesis.content)
-        temp_file_path = temp_file.name
-    return temp_file_path
-
-def coeiroink(styleId, speaker, text):
-    # 音声合成
-    response = requests.post(
-        engine_api + '/v1/predict',
-        json={
-            'text': text,
-            'speakerUuid': speaker,
-            'styleId': styleId,
-            'prosodyDetail': None,
-            'speedScale': 1
-        })
-
-    # 一時ファイルを作成し、音声データを保存
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_file:
-        temp_file.write(response.content)
-        temp_file_path = temp_file.name
-    return temp_file_path
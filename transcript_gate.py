@@ -0,0 +1,88 @@
+# 文字起こしの結果をLLMに渡す前にふるい分ける処理
+# Whisperが無音やノイズに対して出力しがちな定型文と、信頼度の低い文字起こしを捨てる
+# 信頼度はresponse_format="verbose_json"で返されるセグメントごとのno_speech_probとavg_logprobを使う
+import re
+import unicodedata
+
+# Whisperが無音やノイズに対して出力しがちな定型文
+DEFAULT_REJECT_PHRASES = [
+    "ご視聴ありがとうございました",
+    "ありがとうございました",
+    "ご清聴ありがとうございました",
+    "最後までご視聴いただきありがとうございました",
+    "チャンネル登録よろしくお願いします",
+    "チャンネル登録お願いします",
+]
+# 比較の前に取り除く文字(記号と空白)
+IGNORED_CHARACTERS = re.compile(r"[\W_]+")
+
+
+# 全角と半角、記号、空白の違いをなくす関数
+def normalize_transcript(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return IGNORED_CHARACTERS.sub("", text)
+
+
+# SDKの型と辞書のどちらでも値を取り出す関数
+def _field(item, name, default=None):
+    if isinstance(item, dict):
+        return item.get(name, default)
+    return getattr(item, name, default)
+
+
+class TranscriptGate:
+
+    def __init__(self, config):
+        # no_speech_probがこれを超える場合は声が含まれていないとみなす
+        self.no_speech_threshold = config.get("no_speech_threshold", 0.6)
+        # avg_logprobがこれを下回る場合は聞き取れていないとみなす
+        self.logprob_threshold = config.get("logprob_threshold", -1.0)
+        # 2つの条件の組み合わせ方(and: 両方を満たす場合に捨てる(Whisperと同じ), or: どちらかを満たす場合に捨てる)
+        self.confidence_rule = config.get("confidence_rule", "and")
+        if self.confidence_rule not in ("and", "or"):
+            raise ValueError(f"未対応のconfidence_ruleです: {self.confidence_rule} (使用可能: and, or)")
+        phrases = [normalize_transcript(p) for p in config.get("reject_phrases", DEFAULT_REJECT_PHRASES)]
+        phrases = sorted({p for p in phrases if p}, key=len, reverse=True)
+        # 定型文だけで構成されている(繰り返しを含む)文字起こしに一致する
+        self.phrase_pattern = re.compile(f"(?:{'|'.join(map(re.escape, phrases))})+") if phrases else None
+
+    # 文字起こしの結果(verbose_jsonの応答または文字列)を判定する
+    # (文字起こしのテキスト, 捨てる場合はその理由。使う場合はNone)を返す
+    def check(self, transcription):
+        if isinstance(transcription, str):
+            text, segments = transcription, []
+        else:
+            text, segments = _field(transcription, "text", ""), _field(transcription, "segments") or []
+        text = text.strip()
+        normalized = normalize_transcript(text)
+        if not normalized:
+            return text, "empty"
+        if self.phrase_pattern is not None and self.phrase_pattern.fullmatch(normalized):
+            return text, "hallucination"
+        no_speech_prob, avg_logprob = self.confidence(segments)
+        if no_speech_prob is None:
+            return text, None
+        no_speech = no_speech_prob > self.no_speech_threshold
+        low_confidence = avg_logprob < self.logprob_threshold
+        if no_speech and low_confidence:
+            return text, "no_speech"
+        if self.confidence_rule == "or":
+            if no_speech:
+                return text, "no_speech"
+            if low_confidence:
+                return text, "low_confidence"
+        return text, None
+
+    # セグメントの長さで重み付けしたno_speech_probとavg_logprobの平均を返す(セグメントが無い場合はNone)
+    def confidence(self, segments):
+        total = no_speech = logprob = 0.0
+        for segment in segments:
+            if _field(segment, "no_speech_prob") is None or _field(segment, "avg_logprob") is None:
+                continue
+            weight = max(_field(segment, "end", 0.0) - _field(segment, "start", 0.0), 0.0) or 1.0
+            total += weight
+            no_speech += weight * _field(segment, "no_speech_prob")
+            logprob += weight * _field(segment, "avg_logprob")
+        if total == 0:
+            return None, None
+        return no_speech / total, logprob / total
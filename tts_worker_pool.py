@@ -0,0 +1,190 @@
+# pyttsx3の音声合成を別プロセスで行うワーカープール
+# pyttsx3のエンジンは作成したスレッドでしか使えず、runAndWaitの間は他の処理を止めてしまうため、
+# ワーカープロセスごとにエンジンを1つずつ持たせて複数の文を同時に合成する
+# 応答が返ってこなくなったワーカーは終了させて新しいプロセスに置き換える
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# ワーカーの起動を待つ時間(秒)
+START_TIMEOUT = 30.0
+
+
+# ワーカープロセスで実行される関数
+# 親プロセスから(タスクID, テキスト)を受け取り、(タスクID, 成否, 音声データまたはエラー)を返す
+def _worker_main(conn, properties, suffix):
+    try:
+        import pyttsx3
+        engine = pyttsx3.init()
+        for key, value in properties.items():
+            engine.setProperty(key, value)
+        conn.send(("ready", {key: engine.getProperty(key) for key in ("voice", "rate", "volume")}))
+    except Exception as e:
+        conn.send(("error", repr(e)))
+        return
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if task is None:
+            break
+        task_id, text = task
+        # pyttsx3はファイルにしか書き出せないため一度保存してから読み込む
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        try:
+            engine.save_to_file(text, path)
+            engine.runAndWait()
+            with open(path, "rb") as f:
+                conn.send((task_id, True, f.read()))
+        except Exception as e:
+            conn.send((task_id, False, repr(e)))
+        finally:
+            os.remove(path)
+
+
+class Worker:
+
+    def __init__(self, context, index, properties, suffix):
+        self.context = context
+        self.index = index
+        self.properties = properties
+        self.suffix = suffix
+        self.process = None
+        self.conn = None
+        self.task_ids = 0
+
+    # プロセスを起動する(準備ができるまでは待たない)
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_worker_main,
+            args=(child_conn, self.properties, self.suffix),
+            name=f"pyttsx3-worker-{self.index}",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    # エンジンの準備ができるまで待ち、エンジンの設定(声、速さ、音量)を返す
+    def wait_ready(self, timeout=START_TIMEOUT):
+        if not self.conn.poll(timeout):
+            self.stop()
+            raise TimeoutError(f"pyttsx3のワーカー{self.index}が{timeout}秒以内に起動しませんでした")
+        status, value = self.conn.recv()
+        if status != "ready":
+            self.stop()
+            raise RuntimeError(f"pyttsx3のワーカー{self.index}でエンジンを初期化できませんでした: {value}")
+        return value
+
+    # 1文を合成する。timeout秒以内に終わらない場合はTimeoutErrorを送出する
+    def run(self, text, timeout):
+        self.task_ids += 1
+        task_id = self.task_ids
+        self.conn.send((task_id, text))
+        while True:
+            if not self.conn.poll(timeout):
+                raise TimeoutError(f"pyttsx3のワーカー{self.index}が{timeout}秒以内に応答しませんでした")
+            try:
+                received_id, ok, value = self.conn.recv()
+            except EOFError:
+                raise EOFError(f"pyttsx3のワーカー{self.index}が終了しました") from None
+            # 前に中断したタスクの結果は読み捨てる
+            if received_id == task_id:
+                break
+        if not ok:
+            raise RuntimeError(value)
+        return value
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        self.process = None
+
+
+class Pyttsx3WorkerPool:
+
+    # workersは起動するプロセスの数、timeoutは1文の合成を待つ時間(秒)
+    # propertiesはエンジンに設定する値(rate, volume, voiceなど)
+    def __init__(self, workers, timeout=30.0, properties=None, suffix=".mp3"):
+        self.timeout = timeout
+        # Windows(sapi5)と同じ起動方法にそろえ、親プロセスのスレッドの状態を引き継がないようにする
+        context = multiprocessing.get_context("spawn")
+        self.workers = [Worker(context, i, properties or {}, suffix) for i in range(max(1, workers))]
+        # 各プロセスの起動には時間がかかるため、全て起動してからまとめて待つ
+        for worker in self.workers:
+            worker.start()
+        try:
+            self.engine_properties = [worker.wait_ready() for worker in self.workers][0]
+        except Exception:
+            self.close()
+            raise
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        self.lock = threading.Lock()
+        self.restarts = 0
+        # 複数の文をまとめて合成する際に、ワーカーの数だけ同時に依頼するためのスレッド
+        self.executor = ThreadPoolExecutor(max_workers=len(self.workers), thread_name_prefix="pyttsx3")
+        print(f"pyttsx3のワーカーを{len(self.workers)}個起動しました")
+
+    def size(self):
+        return len(self.workers)
+
+    # 空いているワーカーで1文を合成し、音声データを返す
+    def synthesize(self, text):
+        worker = self.idle.get()
+        try:
+            # 前回の再起動に失敗していたワーカー
+            if worker.process is None:
+                self._restart(worker)
+            return worker.run(text, self.timeout)
+        except (TimeoutError, EOFError, OSError):
+            # 応答しない、または終了してしまったワーカーは新しいプロセスに置き換える
+            self._restart(worker)
+            raise
+        finally:
+            self.idle.put(worker)
+
+    # 複数の文を同時に合成し、渡した順に音声データを返す(失敗した文はNone)
+    def synthesize_batch(self, texts):
+        futures = [self.executor.submit(self.synthesize, text) for text in texts]
+        results = []
+        for text, future in zip(texts, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"音声合成に失敗しました: {text} ({e})")
+                results.append(None)
+        return results
+
+    def _restart(self, worker):
+        print(f"pyttsx3のワーカー{worker.index}を再起動します")
+        with self.lock:
+            self.restarts += 1
+        worker.stop()
+        worker.start()
+        try:
+            worker.wait_ready()
+        except Exception as e:
+            # 次に使うときにもう一度再起動を試みる
+            print(f"pyttsx3のワーカー{worker.index}の再起動に失敗しました: {e}")
+
+    def close(self):
+        if hasattr(self, "executor"):
+            self.executor.shutdown(wait=False)
+        for worker in self.workers:
+            worker.stop()